@@ -9,13 +9,14 @@ from os.path import join
 import psycopg2
 from psycopg2.extras import Json
 from psycopg2.sql import SQL, Literal
+import shapely
 import shapely.wkt
 from osgeo import gdal
 import numpy as np
 
 from solar_pv import paths, gdal_helpers
 from solar_pv.db_funcs import connection, sql_command
-from solar_pv.geos import project_geom, from_geojson, square
+from solar_pv.geos import project_geom, from_geojson
 from solar_pv.lidar.bulk_lidar_client import LidarSource
 from solar_pv.lidar.en_to_grid_ref import en_to_grid_ref
 from solar_pv.lidar.lidar import Resolution, zip_to_geotiffs, \
@@ -207,15 +208,20 @@ def model(project_name: str, kwp: float, wkt: str):
         a = band.ReadAsArray()
         to_en = ds.GetGeoTransform()
 
-        monthly_kwh = 0
-        for y, row in enumerate(a):
-            for x, wh in enumerate(row):
-                if not np.isnan(wh):
-                    e, n = gdal.ApplyGeoTransform(to_en, x, y)
-                    cell = square(e - 0.5, n - 0.5, 1)
-                    if cell.intersects(geom):
-                        intersect = cell.intersection(geom)
-                        monthly_kwh += wh * intersect.area * 0.001 * mdays[month] * peak_power_per_m2 * (1 - system_loss)
+        # EN of the top-left corner of each non-nan pixel, as gdal.ApplyGeoTransform would give:
+        ys, xs = np.nonzero(~np.isnan(a))
+        if to_en[2] == 0 and to_en[4] == 0:
+            # No skew (the usual case), so each column/row has a single E/N:
+            e = (to_en[0] + np.arange(a.shape[1]) * to_en[1])[xs]
+            n = (to_en[3] + np.arange(a.shape[0]) * to_en[5])[ys]
+        else:
+            e = to_en[0] + xs * to_en[1] + ys * to_en[2]
+            n = to_en[3] + xs * to_en[4] + ys * to_en[5]
+        cells = shapely.box(e - 0.5, n - 0.5, e + 0.5, n + 0.5)
+        intersecting = shapely.intersects(cells, geom)
+        areas = shapely.area(shapely.intersection(cells[intersecting], geom))
+        wh = a[ys[intersecting], xs[intersecting]]
+        monthly_kwh = float(np.sum(wh * areas)) * 0.001 * mdays[month] * peak_power_per_m2 * (1 - system_loss)
 
         monthly_kwhs.append(monthly_kwh)
         print(monthly_kwh)
@@ -2,17 +2,21 @@
 # Licensed under the Reciprocal Public License v1.5. See LICENSE for licensing details.
 import gzip
 import os
-import shlex
+import shutil
+import sqlite3
 
 import subprocess
 
 import logging
+import threading
 import time
 import traceback
 
-from contextlib import ExitStack, contextmanager
+from contextlib import ExitStack, closing, contextmanager
+from functools import lru_cache
 from os.path import join
 from typing import Union, Optional
+from urllib.parse import urlparse
 
 import psycopg2
 from psycopg2.sql import SQL, Identifier, Composed, Literal
@@ -65,8 +69,34 @@ def sql_script(pg_conn, script_name: str, bindings: dict = None, result_extracto
     The SQL will be interpolated with the keyword args in the standard psycopg2 way
     (https://www.psycopg.org/docs/sql.html#module-psycopg2.sql).
     """
-    with open(join(SQL_DIR, script_name)) as schema_file:
-        return sql_command(pg_conn, schema_file.read(), bindings, result_extractor, **kwargs)
+    return sql_command(pg_conn, _load_script(script_name), bindings, result_extractor, **kwargs)
+
+
+def _load_script(script_name: str) -> str:
+    """
+    Read a SQL script. Scripts in the `sql` directory are cached, as they
+    don't change while the model is running; anything else (e.g. generated
+    SQL files passed as absolute paths) is read fresh each time.
+    """
+    path = join(SQL_DIR, script_name)
+    if os.path.dirname(os.path.abspath(path)) == SQL_DIR:
+        return _load_sql_dir_script(path)
+    with open(path) as schema_file:
+        return schema_file.read()
+
+
+@lru_cache(maxsize=None)
+def _load_sql_dir_script(path: str) -> str:
+    with open(path) as schema_file:
+        return schema_file.read()
+
+
+_UNSAFE_FAST_GPKG_CONFIG = [
+    "--config", "OGR_SQLITE_JOURNAL", "OFF",
+    "--config", "OGR_SQLITE_SYNCHRONOUS", "OFF",
+    "--config", "OGR_SQLITE_CACHE", "1024",
+    "--config", "OGR_SQLITE_PRAGMA", "temp_store=MEMORY",
+]
 
 
 def command_to_gpkg(pg_conn,
@@ -78,43 +108,61 @@ def command_to_gpkg(pg_conn,
                     dst_srs: int,
                     overwrite: bool = False,
                     append: bool = False,
+                    unsafe_fast: bool = False,
+                    defer_spatial_index: bool = False,
                     **kwargs) -> Optional[str]:
+    """
+    Export the output of a SQL command to a table in a geopackage, using ogr2ogr.
+
+    If `unsafe_fast` is set, the SQLite journal is disabled and writes are not synced
+    to disk (https://gdal.org/drivers/vector/gpkg.html#performance-hints). This is much
+    faster, but the geopackage can be corrupted if the process is killed mid-write,
+    and it is not safe for concurrent writers.
+
+    If `defer_spatial_index` is set (and not appending to an existing layer), the
+    spatial index is built once after all the rows are written rather than being
+    updated on each insert.
+
+    :return: ogr2ogr's stderr if it failed, otherwise None
+    """
     logging.info(f"Loading {table_name} into {filename}")
     path = join(os.environ.get("GPKG_DIR", ""), filename)  # If env var is not set just use filename
     exists = os.path.exists(path)
     if overwrite and append:
         overwrite = False
+    # Appending to an existing layer will use the layer's existing index:
+    defer_spatial_index = defer_spatial_index and not append
 
     if len(kwargs) != 0:
         if isinstance(command, str):
             command = SQL(command).format(**kwargs).as_string(pg_conn)
         else:
             command = command.format(**kwargs).as_string(pg_conn)
-
-    res = subprocess.run(shlex.split(
-        f"""ogr2ogr
-        -f GPKG {path}
-        -sql "{command}"
-        -gt 65536
-        -nln {table_name}
-        {"-update" if exists else ""}
-        {"-overwrite" if overwrite else ""}
-        {"-append" if append else ""}
-        -s_srs EPSG:{src_srs}
-        -t_srs EPSG:{dst_srs}
-        "PG:{process_pg_uri(pg_uri)}"
-        """),
-        capture_output=True, text=True)
-
-    # TODO consider:
-    # Re message from Neil Nov 22: I wonder if some of the performance hints mentioned here:
-    # https://gdal.org/drivers/vector/gpkg.html#performance-hints might be worth trying? They sound like they wouldn't
-    # be compatible with concurrent writes but it sounds like that hasn't been working anyway. We saw quite good
-    # performance increases in HNZP when writing geopackages with the following:
-    # (.setJournalMode SQLiteConfig$JournalMode/WAL)
-    # (.setPragma SQLiteConfig$Pragma/SYNCHRONOUS "OFF")
-    # (.setTransactionMode SQLiteConfig$TransactionMode/DEFERRED)
-    # (.setReadUncommited true)
+    elif not isinstance(command, str):
+        command = command.as_string(pg_conn)
+
+    # Pass an argv list rather than a shell-quoted string, so the SQL
+    # doesn't have to survive shell quoting:
+    argv = ["ogr2ogr",
+            "-f", "GPKG", path,
+            "-sql", command,
+            "-gt", "65536",
+            "-nln", table_name]
+    if exists:
+        argv.append("-update")
+    if overwrite:
+        argv.append("-overwrite")
+    if append:
+        argv.append("-append")
+    argv.extend(["-s_srs", f"EPSG:{src_srs}",
+                 "-t_srs", f"EPSG:{dst_srs}"])
+    if unsafe_fast:
+        argv.extend(_UNSAFE_FAST_GPKG_CONFIG)
+    if defer_spatial_index:
+        argv.extend(["-lco", "SPATIAL_INDEX=NO"])
+    argv.append(f"PG:{process_pg_uri(pg_uri)}")
+
+    res = subprocess.run(argv, capture_output=True, text=True)
 
     if res.stdout:
         logging.info(res.stdout)
@@ -122,36 +170,68 @@ def command_to_gpkg(pg_conn,
         logging.error(res.stderr)
         return res.stderr
 
+    if defer_spatial_index:
+        _create_gpkg_spatial_index(path, table_name)
+
     return None
 
 
+def _create_gpkg_spatial_index(path: str, table_name: str) -> None:
+    with closing(sqlite3.connect(path)) as gpkg:
+        row = gpkg.execute("SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?",
+                           (table_name,)).fetchone()
+    if row is None:
+        # Layer has no geometry column, so nothing to index:
+        return
+
+    res = subprocess.run(
+        ["ogrinfo", path, "-sql",
+         f"SELECT CreateSpatialIndex({_sqlite_literal(table_name)}, {_sqlite_literal(row[0])})"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if res.returncode != 0:
+        raise ValueError(f"Failed to create spatial index on {table_name} in {path}: {res.stderr}")
+
+
+def _sqlite_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
 # TODO remove
 def sql_script_with_bindings(pg_conn, script_name: str, bindings: dict, **kwargs):
     """Run one of the SQL scripts in the `database` directory, with named
     prepared-statement bindings. """
     with pg_conn.cursor() as cursor:
-        with open(join(SQL_DIR, script_name)) as schema_file:
-            cursor.execute(SQL(schema_file.read()).format(**kwargs), bindings)
-            pg_conn.commit()
+        cursor.execute(SQL(_load_script(script_name)).format(**kwargs), bindings)
+        pg_conn.commit()
+
+
+COPY_BUFSIZE = 1 << 20
+"""
+Size of the chunks that file data is read and sent to postgres in by the COPY helpers
+"""
 
 
 def copy_tsv(pg_conn, file_name: str, table: str, sep='\t', null=PG_NULL, encoding='utf-8'):
     """Using the postgres COPY command, load data into a table from a TSV file."""
     with pg_conn.cursor() as cursor:
-        with open(file_name, encoding=encoding) as f:
-            copy_sql = SQL("COPY {table} FROM stdin (DELIMITER {sep}, NULL {null})").format(
+        # Files are passed through as raw bytes and decoded by postgres:
+        with open(file_name, 'rb', buffering=COPY_BUFSIZE) as f:
+            copy_sql = SQL("COPY {table} FROM stdin (DELIMITER {sep}, NULL {null}, ENCODING {encoding})").format(
                 table=Identifier(*table.split(".")),
                 sep=Literal(sep),
-                null=Literal(null))
-            cursor.copy_expert(copy_sql, f)
+                null=Literal(null),
+                encoding=Literal(encoding))
+            cursor.copy_expert(copy_sql, f, size=COPY_BUFSIZE)
             pg_conn.commit()
 
 
 def copy_csv(pg_conn, file_name: str, table: str, encoding='utf-8'):
     with pg_conn.cursor() as cursor:
-        with open(file_name, encoding=encoding) as f:
-            copy_sql = SQL("COPY {} FROM stdin (FORMAT 'csv', HEADER)").format(Identifier(*table.split(".")))
-            cursor.copy_expert(copy_sql, f)
+        with open(file_name, 'rb', buffering=COPY_BUFSIZE) as f:
+            copy_sql = SQL("COPY {table} FROM stdin (FORMAT 'csv', HEADER, ENCODING {encoding})").format(
+                table=Identifier(*table.split(".")),
+                encoding=Literal(encoding))
+            cursor.copy_expert(copy_sql, f, size=COPY_BUFSIZE)
             pg_conn.commit()
 
 
@@ -170,22 +250,67 @@ def _command_to_csv(pg_conn, file, command: str, **kwargs):
         cursor.copy_expert(copy_sql, file)
         pg_conn.commit()
 
+def _pipelined_command_to_csv(pg_conn, file, command: str, **kwargs):
+    """
+    Like `_command_to_csv`, but the COPY runs in a background thread writing to
+    a pipe, so that reading from postgres overlaps with writing (and e.g.
+    compressing) the output file.
+    """
+    r, w = os.pipe()
+    errors = []
+
+    def _copy():
+        try:
+            with os.fdopen(w, 'wb', buffering=COPY_BUFSIZE) as pipe_out:
+                _command_to_csv(pg_conn, pipe_out, command, **kwargs)
+        except BaseException as e:
+            errors.append(e)
+
+    copier = threading.Thread(target=_copy)
+    copier.start()
+    try:
+        # If writing fails, closing the read end stops the copier with a broken pipe:
+        with os.fdopen(r, 'rb') as pipe_in:
+            shutil.copyfileobj(pipe_in, file, COPY_BUFSIZE)
+    finally:
+        copier.join()
+    if errors:
+        raise errors[0]
+
 def command_to_csv(pg_conn, file_name: str, command: str, encoding='utf-8', **kwargs):
     """Using the postgres COPY command, export the output of a SQL command to a CSV file."""
     with open(file_name, 'w', encoding=encoding) as f:
         _command_to_csv(pg_conn, f, command, **kwargs)
 
 def command_to_csv_gzip(pg_conn, file_name: str, command: str, **kwargs):
-    """Using the postgres COPY command, export the output of a SQL command to a gzipped CSV file."""
-    with gzip.open(file_name, 'w') as f:
-        _command_to_csv(pg_conn, f, command, **kwargs)
+    """
+    Using the postgres COPY command, export the output of a SQL command to a gzipped CSV file.
+
+    Compresses using pigz (multi-threaded) if it is on the PATH, otherwise
+    falls back to the single-threaded gzip module.
+    """
+    pigz = shutil.which("pigz")
+    if pigz is None:
+        with gzip.open(file_name, 'w') as f:
+            _pipelined_command_to_csv(pg_conn, f, command, **kwargs)
+        return
+
+    with open(file_name, 'wb') as f:
+        proc = subprocess.Popen([pigz, "-c"], stdin=subprocess.PIPE, stdout=f)
+        try:
+            _command_to_csv(pg_conn, proc.stdin, command, **kwargs)
+        finally:
+            proc.stdin.close()
+            returncode = proc.wait()
+    if returncode != 0:
+        raise ValueError(f"pigz exited with code {returncode} while writing {file_name}")
 
 
 def script_to_csv(pg_conn, file_name: str, script: str, encoding='utf-8', **kwargs):
-    with open(join(SQL_DIR, script)) as schema_file:
-        return command_to_csv(pg_conn, file_name, schema_file.read(), encoding, **kwargs)
+    return command_to_csv(pg_conn, file_name, _load_script(script), encoding, **kwargs)
 
 
+@lru_cache(maxsize=32)
 def process_pg_uri(pg_uri: str) -> str:
     """
     Some versions of ogr2ogr attempt to add an 'application name' parameter
@@ -196,7 +321,6 @@ def process_pg_uri(pg_uri: str) -> str:
     if 'application_name' in pg_uri:
         return pg_uri
 
-    from urllib.parse import urlparse
     parsed = urlparse(pg_uri)
     if parsed.scheme == '':
         # Not a URI, probably the 'key=value' form of PG connection string:
@@ -233,25 +357,18 @@ def connection(pg_uri: str, **kwargs):
 
 
 def count(pg_uri: str, schema: str, table: str) -> int:
-    pg_conn = connect(pg_uri)
-    try:
+    """
+    Count the rows in a table, or return 0 if it does not exist.
+    """
+    with connection(pg_uri) as pg_conn:
         with pg_conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables
-                    WHERE table_schema = %(schema)s
-                    AND table_name = %(table)s
-                );
-            """, {"schema": schema, "table": table})
-            exists = cursor.fetchone()[0] is True
-            if not exists:
+            cursor.execute("SELECT to_regclass(%s)", (Identifier(schema, table).as_string(pg_conn),))
+            if cursor.fetchone()[0] is None:
                 return 0
-            cursor.execute(SQL("SELECT COUNT(*) FROM {table} LIMIT 1").format(
+            cursor.execute(SQL("SELECT COUNT(*) FROM {table}").format(
                 table=Identifier(schema, table)
             ))
             return cursor.fetchone()[0]
-    finally:
-        pg_conn.close()
 
 
 def get_max_connections(pg_conn) -> int:
@@ -1,32 +1,87 @@
 # This file is part of the solar wizard PV suitability model, copyright © Centre for Sustainable Energy, 2020-2023
 # Licensed under the Reciprocal Public License v1.5. See LICENSE for licensing details.
-import json
 import logging
 import os
-import shlex
+import re
 import subprocess
-import textwrap
-from typing import List, Tuple, Union, Callable
+import uuid
+from contextlib import contextmanager, ExitStack
+from functools import lru_cache
+from typing import List, Tuple, Union, Callable, Optional, Dict
 
 import math
 import numpy as np
 from osgeo import gdal
+from osgeo_utils import gdal_calc
 
-from solar_pv.util import esc_double_quotes
+gdal.UseExceptions()
+
+GDAL_CONFIG = {
+    "GDAL_NUM_THREADS": "ALL_CPUS",
+}
+"""
+GDAL config for heavy raster processing, applied with `gdal_config()`.
+"""
+
+GDAL_CACHE_FRACTION = 0.25
+"""
+Fraction of RAM to use for GDAL's block cache during `gdal_config()`. The
+default (5% of RAM) is too small for mosaics of large LiDAR tiles.
+"""
+
+
+@contextmanager
+def gdal_config(options: Optional[Dict[str, str]] = None):
+    """
+    Set GDAL config options (by default `GDAL_CONFIG`) and enlarge GDAL's
+    block cache for the duration of the block, restoring both afterwards.
+    Anything already configured, e.g. as an environment variable, is left alone.
+
+    The block cache size is set with `gdal.SetCacheMax()` rather than the
+    GDAL_CACHEMAX config option, as GDAL only reads that option once.
+    """
+    if options is None:
+        options = GDAL_CONFIG
+    to_set = {k: v for k, v in options.items() if gdal.GetConfigOption(k) is None}
+    for k, v in to_set.items():
+        gdal.SetConfigOption(k, v)
+    cache_max = gdal.GetCacheMax()
+    if gdal.GetConfigOption("GDAL_CACHEMAX") is None:
+        gdal.SetCacheMax(max(cache_max, int(_total_memory() * GDAL_CACHE_FRACTION)))
+    try:
+        yield
+    finally:
+        gdal.SetCacheMax(cache_max)
+        for k in to_set:
+            gdal.SetConfigOption(k, None)
+
+
+def _total_memory() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+CREATION_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=YES']
+"""
+GeoTIFF creation options for rasters written by these helpers. DEFLATE
+compression is multi-threaded by libtiff/GDAL when NUM_THREADS is set.
+No PREDICTOR is set, as it depends on the data type of the raster.
+"""
+
+WARP_KWARGS = dict(multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'], warpMemoryLimit=2 << 30)
+"""
+Options to gdal.Warp to use all CPUs for warping, and a large enough
+working buffer (2GB) that big rasters aren't split into many small chunks
+"""
 
 
 def create_vrt(tiles: List[str], vrt_file: str):
     logging.info("Creating vrt...")
     if tiles and len(tiles) > 0:
-        command = f"gdalbuildvrt -resolution highest {vrt_file} {' '.join(tiles)}"
-
         logging.info("Creating .vrt")
-
-        res = subprocess.run(shlex.split(command), capture_output=True, text=True)
-        print(res.stdout.strip())
-        if res.returncode != 0:
-            print(res.stderr.strip())
-            raise ValueError(res.stderr)
+        # Tile list is passed directly rather than via argv, which can
+        # exceed ARG_MAX with many thousands of tiles:
+        vrt = gdal.BuildVRT(vrt_file, tiles, resolution="highest")
+        vrt = None
     else:
         logging.warning("No tiles passed, not creating vrt")
 
@@ -37,20 +92,13 @@ def files_in_vrt(vrt_file: str) -> List[str]:
         logging.warning(f"Vrt {vrt_file} does not exist, not extracting file list")
         return []
 
-    res = subprocess.run(f"gdalinfo -json {vrt_file}",
-                         capture_output=True, text=True, shell=True)
-    if res.returncode != 0:
-        print(res.stderr)
-        raise ValueError(res.stderr)
-    json_out = json.loads(res.stdout)
-    return [f for f in json_out['files'] if f != os.path.basename(f)]
+    # This is the same file list that `gdalinfo -json` reports:
+    files = gdal.Open(vrt_file).GetFileList()
+    return [f for f in files if f != os.path.basename(f)]
 
 
 def get_res(filename: str) -> float:
-    gdal.UseExceptions()
-
-    f = gdal.Open(filename)
-    _, xres, _, _, _, yres = f.GetGeoTransform()
+    _, xres, _, _, _, yres = _geotransform(filename)
     xres = round(xres, 10)
     yres = round(yres, 10)
     if abs(xres) == abs(yres):
@@ -61,10 +109,7 @@ def get_res(filename: str) -> float:
 
 
 def get_xres_yres(filename: str) -> (float, float):
-    gdal.UseExceptions()
-
-    f = gdal.Open(filename)
-    _, xres, _, _, _, yres = f.GetGeoTransform()
+    _, xres, _, _, _, yres = _geotransform(filename)
     xres = round(xres, 10)
     yres = round(yres, 10)
     return xres, yres
@@ -75,29 +120,17 @@ def get_res_unchecked(filename: str) -> float:
     Get the resolution of the raster, and do not raise an error
     if the x and y resolutions differ - return the x res.
     """
-    gdal.UseExceptions()
-
-    f = gdal.Open(filename)
-    _, xres, _, _, _, yres = f.GetGeoTransform()
+    _, xres, _, _, _, yres = _geotransform(filename)
     return abs(xres)
 
 
 def get_srs_units(filename: str) -> Tuple[float, str]:
-    gdal.UseExceptions()
-
-    f = gdal.Open(filename)
-    sref = f.GetSpatialRef()
-    sref.AutoIdentifyEPSG()
-    return float(sref.GetLinearUnits()), sref.GetLinearUnitsName()
+    units, units_name, _ = _srs_info(filename)
+    return units, units_name
 
 
 def get_srid(filename: str, fallback: int = None) -> int:
-    gdal.UseExceptions()
-
-    f = gdal.Open(filename)
-    sref = f.GetSpatialRef()
-    sref.AutoIdentifyEPSG()
-    code = sref.GetAuthorityCode(None)
+    _, _, code = _srs_info(filename)
     if code:
         logging.info(f"SRID of {filename} detected: {code}")
         return int(code)
@@ -109,23 +142,61 @@ def get_srid(filename: str, fallback: int = None) -> int:
     raise ValueError(f"Failed to detect SRID of {filename} and no fallback set!")
 
 
+def _file_version(filename: str) -> Optional[Tuple[int, int]]:
+    """
+    Modification time (in ns) and size of a raster, used to invalidate cached
+    metadata if the file is overwritten. The size is included as well, as a
+    file can be rewritten within one tick of a coarse filesystem timestamp.
+    None for paths that aren't on the filesystem (e.g. /vsimem/)
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _geotransform(filename: str) -> Tuple[float, float, float, float, float, float]:
+    version = _file_version(filename)
+    if version is None:
+        return _read_geotransform.__wrapped__(filename, version)
+    return _read_geotransform(filename, version)
+
+
+@lru_cache(maxsize=256)
+def _read_geotransform(filename: str, version: Optional[Tuple[int, int]]) -> Tuple[float, float, float, float, float, float]:
+    f = gdal.Open(filename)
+    return tuple(f.GetGeoTransform())
+
+
+def _srs_info(filename: str) -> Tuple[float, str, Optional[str]]:
+    version = _file_version(filename)
+    if version is None:
+        return _read_srs_info.__wrapped__(filename, version)
+    return _read_srs_info(filename, version)
+
+
+@lru_cache(maxsize=256)
+def _read_srs_info(filename: str, version: Optional[Tuple[int, int]]) -> Tuple[float, str, Optional[str]]:
+    """
+    Linear units, linear units name and EPSG code (if detected) of a raster's
+    SRS. Cached as AutoIdentifyEPSG has to search the PROJ database.
+    """
+    f = gdal.Open(filename)
+    sref = f.GetSpatialRef()
+    sref.AutoIdentifyEPSG()
+    return float(sref.GetLinearUnits()), sref.GetLinearUnitsName(), sref.GetAuthorityCode(None)
+
+
 def rasterize(pg_uri: str, mask_sql: str, mask_file: str, res: float, srid: int):
-    cmd = shlex.split(f"""
-        gdal_rasterize
-        -sql "{mask_sql}"
-        -burn 1 -tr {res} {res}
-        -init 0 -ot Int16
-        -of GTiff -a_srs EPSG:{srid}
-        -tap
-        "PG:{pg_uri}"
-        {mask_file}
-        """)
-    res = subprocess.run(cmd, capture_output=True, text=True)
-
-    print(res.stdout)
-    print(res.stderr)
-    if res.returncode != 0:
-        raise ValueError(res.stderr)
+    with _pg_datasource(pg_uri) as pg_ds:
+        gdal.Rasterize(mask_file, pg_ds,
+                       SQLStatement=mask_sql,
+                       burnValues=[1], xRes=res, yRes=res,
+                       initValues=[0], outputType=gdal.GDT_Int16,
+                       format="GTiff", outputSRS=f"EPSG:{srid}",
+                       targetAlignedPixels=True,
+                       creationOptions=CREATION_OPTIONS)
 
 
 def rasterize_3d(pg_uri: str,
@@ -144,56 +215,54 @@ def rasterize_3d(pg_uri: str,
         xres = res[0]
         yres = res[1]
 
-    res = subprocess.run(f"""
-        gdal_rasterize
-        -sql "{esc_double_quotes(mask_sql)}"
-        -3d -tr {xres} {yres}
-        -init {math.nan} -ot {output_type}
-        -of GTiff -a_srs EPSG:{srid}
-        "PG:{pg_uri}"
-        {mask_file}
-        """.replace("\n", " "), capture_output=True, text=True, shell=True)
-    print(res.stdout)
-    print(res.stderr)
-    if res.returncode != 0:
-        raise ValueError(res.stderr)
+    with _pg_datasource(pg_uri) as pg_ds:
+        gdal.Rasterize(mask_file, pg_ds,
+                       SQLStatement=mask_sql,
+                       useZ=True, xRes=xres, yRes=yres,
+                       initValues=[math.nan], outputType=gdal.GetDataTypeByName(output_type),
+                       format="GTiff", outputSRS=f"EPSG:{srid}",
+                       creationOptions=CREATION_OPTIONS)
 
 
 def rasterize_3d_update(pg_uri: str, mask_sql: str, raster_to_update_filename: str):
     """
     Updates a raster. Uses the Z value for the burn value for each polygon inplace into raster_to_update_filename
     """
-    res = subprocess.run(f"""
-        gdal_rasterize
-        -sql "{esc_double_quotes(mask_sql)}"
-        -3d 
-        "PG:{pg_uri}"
-        {raster_to_update_filename}
-        """.replace("\n", " "), capture_output=True, text=True, shell=True)
-    print(res.stdout)
-    print(res.stderr)
-    if res.returncode != 0:
-        raise ValueError(res.stderr)
+    to_update = gdal.Open(raster_to_update_filename, gdal.GA_Update)
+    with _pg_datasource(pg_uri) as pg_ds:
+        gdal.Rasterize(to_update, pg_ds,
+                       SQLStatement=mask_sql,
+                       useZ=True)
+    to_update = None
+
+
+@contextmanager
+def _pg_datasource(pg_uri: str):
+    """
+    Open the postgres DB as an OGR datasource, closing it on exit.
+    """
+    ds = gdal.OpenEx(f"PG:{pg_uri}", gdal.OF_VECTOR)
+    try:
+        yield ds
+    finally:
+        ds = None
 
 
 def calc(raster_a: str, raster_b: str, expression: str, raster_out: str):
     """Create a new raster from 2 others merged using an expression
     """
-    res = subprocess.run(f"""
-        gdal_calc.py
-        --calc="{expression}"
-        -A "{raster_a}"
-        -B "{raster_b}"
-        --outfile="{raster_out}"
-        --type=Float32
-        --format=GTiff
-        --extent=union
-        --projectionCheck
-        """.replace("\n", " "), capture_output=True, text=True, shell=True)
-    print(res.stdout)
-    print(res.stderr)
-    if res.returncode != 0:
-        raise ValueError(res.stderr)
+    # Run in-process rather than shelling out to gdal_calc.py:
+    out = gdal_calc.Calc(calc=expression,
+                         A=raster_a,
+                         B=raster_b,
+                         outfile=raster_out,
+                         type="Float32",
+                         format="GTiff",
+                         creation_options=CREATION_OPTIONS,
+                         extent="union",
+                         projectionCheck=True,
+                         quiet=True)
+    out = None
 
 
 def crop_or_expand(file_to_crop: str,
@@ -206,25 +275,24 @@ def crop_or_expand(file_to_crop: str,
 
     If adjust_resolution is set, the resolution of the output will match the reference file
     """
-    gdal.UseExceptions()
-
     to_crop = gdal.Open(file_to_crop)
     ref = gdal.Open(reference_file)
     ulx, xres, xskew, uly, yskew, yres = ref.GetGeoTransform()
     lrx = ulx + (ref.RasterXSize * xres)
     lry = uly + (ref.RasterYSize * yres)
     if adjust_resolution:
-        gdal.Warp(out_tiff, to_crop, outputBounds=(ulx, lry, lrx, uly), xRes=xres, yRes=yres,
-                  creationOptions=['TILED=YES', 'COMPRESS=PACKBITS', 'BIGTIFF=YES'])
+        if not _translate_window(to_crop, out_tiff, (ulx, lry, lrx, uly), xres, yres):
+            gdal.Warp(out_tiff, to_crop, outputBounds=(ulx, lry, lrx, uly), xRes=xres, yRes=yres,
+                      creationOptions=CREATION_OPTIONS, **WARP_KWARGS)
     else:
-        gdal.Warp(out_tiff, to_crop, outputBounds=(ulx, lry, lrx, uly),
-                  creationOptions=['TILED=YES', 'COMPRESS=PACKBITS', 'BIGTIFF=YES'])
+        _, src_xres, _, _, _, src_yres = to_crop.GetGeoTransform()
+        if not _translate_window(to_crop, out_tiff, (ulx, lry, lrx, uly), src_xres, src_yres):
+            gdal.Warp(out_tiff, to_crop, outputBounds=(ulx, lry, lrx, uly),
+                      creationOptions=CREATION_OPTIONS, **WARP_KWARGS)
 
 
 def expand(raster_in: str, raster_out: str, buffer: int):
     """Assumes buffer is in same unit as SRS"""
-    gdal.UseExceptions()
-
     ref = gdal.Open(raster_in)
     ulx, xres, xskew, uly, yskew, yres = ref.GetGeoTransform()
 
@@ -235,9 +303,37 @@ def expand(raster_in: str, raster_out: str, buffer: int):
 
     lrx = ulx + (ref.RasterXSize * xres) + x_buffer
     lry = uly + (ref.RasterYSize * yres) + y_buffer
-    gdal.Warp(raster_out, raster_in,
-              outputBounds=(ulx - x_buffer, lry, lrx, uly - y_buffer),
-              creationOptions=['TILED=YES', 'COMPRESS=PACKBITS', 'BIGTIFF=YES'])
+    bounds = (ulx - x_buffer, lry, lrx, uly - y_buffer)
+    if not _translate_window(ref, raster_out, bounds, xres, yres):
+        gdal.Warp(raster_out, ref, outputBounds=bounds,
+                  creationOptions=CREATION_OPTIONS, **WARP_KWARGS)
+
+
+def _translate_window(src, out_tiff: str, bounds: Tuple[float, float, float, float],
+                      xres: float, yres: float) -> bool:
+    """
+    Crop or expand `src` to `bounds` (minx, miny, maxx, maxy) using gdal.Translate,
+    if that can be done without resampling: i.e. the output has the same resolution
+    and pixel grid as `src`, which is north-up. This copies the pixels directly
+    rather than putting them through the warper.
+
+    :return: False (and does nothing) if resampling would be required.
+    """
+    src_ulx, src_xres, src_xskew, src_uly, src_yskew, src_yres = src.GetGeoTransform()
+    if src_xskew != 0 or src_yskew != 0 or src_xres <= 0 or src_yres >= 0:
+        return False
+    if not math.isclose(src_xres, abs(xres)) or not math.isclose(src_yres, -abs(yres)):
+        return False
+
+    minx, miny, maxx, maxy = bounds
+    xoff = (minx - src_ulx) / src_xres
+    yoff = (maxy - src_uly) / src_yres
+    if not math.isclose(xoff, round(xoff), abs_tol=1e-6) or not math.isclose(yoff, round(yoff), abs_tol=1e-6):
+        return False
+
+    gdal.Translate(out_tiff, src, projWin=(minx, maxy, maxx, miny),
+                   creationOptions=CREATION_OPTIONS)
+    return True
 
 
 def reproject(raster_in: str, raster_out: str, src_srs: str, dst_srs: str):
@@ -249,11 +345,11 @@ def reproject(raster_in: str, raster_out: str, src_srs: str, dst_srs: str):
     lrx = ulx + (ref.RasterXSize * xres)
     lry = uly + (ref.RasterYSize * yres)
 
-    gdal.Warp(raster_out, raster_in, dstSRS=dst_srs, srcSRS=src_srs,
+    gdal.Warp(raster_out, ref, dstSRS=dst_srs, srcSRS=src_srs,
               width=ref.RasterXSize, height=ref.RasterYSize,
               # resampleAlg="bilinear",
               outputBounds=(ulx, lry, lrx, uly), outputBoundsSRS=src_srs,
-              creationOptions=['TILED=YES', 'COMPRESS=PACKBITS', 'BIGTIFF=YES'])
+              creationOptions=CREATION_OPTIONS, **WARP_KWARGS)
 
 
 def reproject_within_bounds(raster_in: str, raster_out: str, src_srs: str, dst_srs: str,
@@ -266,7 +362,7 @@ def reproject_within_bounds(raster_in: str, raster_out: str, src_srs: str, dst_s
     gdal.Warp(raster_out, raster_in, dstSRS=dst_srs, srcSRS=src_srs,
               width=width, height=height,
               outputBounds=bounds,
-              creationOptions=['TILED=YES', 'COMPRESS=PACKBITS'])
+              creationOptions=CREATION_OPTIONS, **WARP_KWARGS)
 
 
 def set_resolution(in_tiff: str,
@@ -275,20 +371,22 @@ def set_resolution(in_tiff: str,
     """
     Output a new version of a raster with the specified resolution
     """
-    gdal.UseExceptions()
     in_f = gdal.Open(in_tiff)
     _, xres, _, _, _, yres = in_f.GetGeoTransform()
     gdal.Warp(out_tiff, in_f, xRes=res, yRes=res,
-              creationOptions=['TILED=YES', 'COMPRESS=PACKBITS', 'BIGTIFF=YES'])
+              creationOptions=CREATION_OPTIONS, **WARP_KWARGS)
     return out_tiff
 
 
 def aspect(cropped_lidar: str, aspect_file: str):
-    run(f"gdaldem aspect {cropped_lidar} {aspect_file} -of GTiff -b 1 -zero_for_flat -co \"COMPRESS=PACKBITS\" -co \"TILED=YES\" -co \"BIGTIFF=YES\"")
+    gdal.DEMProcessing(aspect_file, cropped_lidar, "aspect", format="GTiff", band=1,
+                       zeroForFlat=True,
+                       creationOptions=CREATION_OPTIONS)
 
 
 def slope(cropped_lidar: str, slope_file: str):
-    run(f"gdaldem slope {cropped_lidar} {slope_file} -of GTiff -b 1  -co \"COMPRESS=PACKBITS\" -co \"TILED=YES\" -co \"BIGTIFF=YES\"")
+    gdal.DEMProcessing(slope_file, cropped_lidar, "slope", format="GTiff", band=1,
+                       creationOptions=CREATION_OPTIONS)
 
 
 def merge(files: List[str], output_file: str, res: float, nodata: int):
@@ -298,36 +396,116 @@ def merge(files: List[str], output_file: str, res: float, nodata: int):
     (except where the earlier tile pixel is NODATA)
     """
     logging.info(f"Merging tiles {files} into {output_file}...")
-    run(f"gdal_merge.py -ps {res} {res} -n {nodata} -a_nodata {nodata} -o {output_file} {' '.join(files)}")
+    # Mosaic via an in-memory VRT, where later sources take priority and NODATA
+    # source pixels are skipped, then write it out with multi-threaded compression:
+    vrt = gdal.BuildVRT("", files, resolution="user", xRes=res, yRes=res,
+                        srcNodata=nodata, VRTNodata=nodata)
+    gdal.Translate(output_file, vrt, format="GTiff", noData=nodata,
+                   creationOptions=CREATION_OPTIONS)
+    vrt = None
     return output_file
 
 
+@contextmanager
+def vsimem_path(suffix: str = ".tif"):
+    """
+    Yields a path in GDAL's in-memory filesystem, for intermediate rasters
+    that don't need to be written to disk. The file is freed on exit.
+    """
+    path = f"/vsimem/{uuid.uuid4().hex}{suffix}"
+    try:
+        yield path
+    finally:
+        if gdal.VSIStatL(path) is not None:
+            gdal.Unlink(path)
+
+
 def count_raster_pixels(tiff: str, value, band: int = 1) -> int:
     """
     Count the pixels in a raster that have value `value`
     """
     file = gdal.Open(tiff)
-    band = file.GetRasterBand(band)
-    a = band.ReadAsArray()
-    return (a == value).sum()
+    hits, _ = _count_and_size(file.GetRasterBand(band), value)
+    return hits
+
 
+APPROX_MIN_PIXELS = 1_000_000
+"""Smallest overview that `count_raster_pixels_pct(approx=True)` will read"""
 
-def count_raster_pixels_pct(tiff: str, value, band: int = 1) -> float:
+
+def count_raster_pixels_pct(tiff: str, value, band: int = 1, approx: bool = False) -> float:
     """
     Count the percentage of pixels in a raster that have value `value`
+
+    If `approx` is set and the raster has overviews, the count is taken from the
+    coarsest overview that still has at least `APPROX_MIN_PIXELS` pixels. This reads
+    far less data, but the result is only as accurate as the overview: exact
+    away from edges for nearest-neighbour overviews of e.g. masks, but not
+    otherwise.
     """
     file = gdal.Open(tiff)
-    band = file.GetRasterBand(band)
-    a = band.ReadAsArray()
-    return (a == value).sum() / a.size
+    rb = file.GetRasterBand(band)
+    if approx:
+        rb = _coarsest_overview(rb, APPROX_MIN_PIXELS)
+    hits, total = _count_and_size(rb, value)
+    return hits / total
 
 
-def run(command: str):
-    command = textwrap.dedent(command).replace("\n", " ").strip()
-    res = subprocess.run(command, capture_output=True, text=True, shell=True)
-    stdout = res.stdout.strip()
-    if stdout:
-        print(stdout)
+def _coarsest_overview(band, min_pixels: int):
+    """
+    The coarsest overview of `band` with at least `min_pixels` pixels, or
+    the band itself if there is no such overview.
+    """
+    best = band
+    for i in range(band.GetOverviewCount()):
+        ovr = band.GetOverview(i)
+        if ovr.XSize * ovr.YSize >= min_pixels and ovr.XSize * ovr.YSize < best.XSize * best.YSize:
+            best = ovr
+    return best
+
+
+def _count_and_size(band, value) -> Tuple[int, int]:
+    """
+    Count the pixels in a band that have value `value`, and the total number of
+    pixels in the band. Reads the band one block at a time rather than all at once.
+    """
+    bx, by = band.GetBlockSize()
+    x_size = band.XSize
+    y_size = band.YSize
+    hits = 0
+    total = 0
+    # Re-used for each block's comparison rather than allocating a new array each time:
+    buf = np.empty((by, bx), dtype=bool)
+    for yoff in range(0, y_size, by):
+        for xoff in range(0, x_size, bx):
+            a = band.ReadAsArray(xoff, yoff, min(bx, x_size - xoff), min(by, y_size - yoff))
+            eq = buf[:a.shape[0], :a.shape[1]]
+            np.equal(a, value, out=eq)
+            hits += int(np.count_nonzero(eq))
+            total += a.size
+    return hits, total
+
+
+_NEWLINE = re.compile(r"\s*\n\s*")
+"""Newlines, and the indentation around them, in multi-line command strings"""
+
+
+def run(command: Union[str, List[str]], out_file: Optional[str] = None):
+    """
+    Run a command, raising a ValueError if it fails. A list is run directly as
+    an argv; a string is run through the shell (e.g. if it needs pipes).
+
+    If `out_file` is set, the command's stdout is written to it rather than printed.
+    """
+    with ExitStack() as stack:
+        stdout = stack.enter_context(open(out_file, 'w')) if out_file else subprocess.PIPE
+        if isinstance(command, str):
+            command = _NEWLINE.sub(" ", command).strip()
+            res = subprocess.run(command, stdout=stdout, stderr=subprocess.PIPE, text=True, shell=True)
+        else:
+            res = subprocess.run(command, stdout=stdout, stderr=subprocess.PIPE, text=True)
+    if res.stdout and res.stdout.strip():
+        print(res.stdout.strip())
     if res.returncode != 0:
         stderr = res.stderr.strip()
         if stderr:
@@ -2,38 +2,57 @@
 # Licensed under the Reciprocal Public License v1.5. See LICENSE for licensing details.
 import itertools
 import json
-from typing import List, Tuple, Union, cast
+from typing import List, Tuple, Union
 
 import math
 import numpy as np
+import shapely
 from shapely.geometry.base import BaseGeometry, BaseMultipartGeometry
 from shapely import LinearRing
 from shapely.prepared import prep
-from shapely.strtree import STRtree
 from shapely.geometry import Polygon, shape, MultiPolygon, mapping, LineString, \
     MultiPoint, MultiLineString
-from shapely import wkt, ops
+from shapely import wkb, ops
 
 from solar_pv.db_funcs import sql_command
-from solar_pv.lidar.en_to_grid_ref import en_to_grid_ref, is_in_range
+from solar_pv.lidar.en_to_grid_ref import en_to_grid_refs, in_range
 from solar_pv.util import round_down_to, round_up_to, frange
 
+# orjson is optional, but parses large GeoJSON files much faster:
+try:
+    import orjson as _geojson_parser
+except ImportError:
+    _geojson_parser = json
+
 
 def rect(x: float, y: float, w: float, h: float) -> Polygon:
-    return Polygon([(x, y),
-                    (x, y + h),
-                    (x + w, y + h),
-                    (x + w, y),
-                    (x, y)])
+    return shapely.box(x, y, x + w, y + h, ccw=False)
+
+
+def rects(xs, ys, w: float, h: float) -> np.ndarray:
+    """
+    Vectorised `rect`: an array of rectangles with SW corners at `xs`, `ys`,
+    built in one call rather than one Polygon at a time.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    return shapely.box(xs, ys, xs + w, ys + h, ccw=False)
 
 
 def square(x: float, y: float, edge: float) -> Polygon:
     return rect(x, y, edge, edge)
 
 
+def squares(xs, ys, edge: float) -> np.ndarray:
+    """
+    Vectorised `square`.
+    """
+    return rects(xs, ys, edge, edge)
+
+
 def from_geojson(geojson):
-    if isinstance(geojson, str):
-        geojson = json.loads(geojson)
+    if isinstance(geojson, (str, bytes)):
+        geojson = _geojson_parser.loads(geojson)
     return shape(geojson)
 
 
@@ -53,7 +72,7 @@ def to_geojson_dict(geom):
 
 
 def from_geojson_file(geojson_file: str):
-    with open(geojson_file) as f:
+    with open(geojson_file, 'rb') as f:
         return from_geojson(f.read())
 
 
@@ -62,18 +81,18 @@ def bounds_polygon(pg_conn, job_id: int) -> Polygon:
     Returns a shapely polygon of the job bounds, which will be buffered
     by the horizon_search_distance if it's a PV job.
     """
-    text = sql_command(
+    bounds = sql_command(
         pg_conn,
         """
         SELECT 
-           ST_AsText(ST_Buffer(bounds, coalesce((params->>'horizon_search_radius')::int, 0))) AS bounds
+           ST_AsBinary(ST_Buffer(bounds, coalesce((params->>'horizon_search_radius')::int, 0))) AS bounds
         FROM models.job_queue
         WHERE job_id = %(job_id)s 
         """,
         bindings={"job_id": job_id},
         result_extractor=lambda res: res[0][0]
     )
-    return wkt.loads(text)
+    return wkb.loads(bytes(bounds))
 
 
 def get_grid_cells(poly, cell_w, cell_h, spacing_w=0, spacing_h=0, grid_start: str = 'origin') -> List[Polygon]:
@@ -84,7 +103,19 @@ def get_grid_cells(poly, cell_w, cell_h, spacing_w=0, spacing_h=0, grid_start: s
     (0,0) if extended (useful for making OS grid refs). Otherwise
     if `grid_start` == 'bounds' grid starts at (xmin, ymin) of poly.
     """
+    _, _, cells = _grid_cells(poly, cell_w, cell_h, spacing_w, spacing_h, grid_start)
+    return list(cells)
+
+
+def _grid_cells(poly, cell_w, cell_h, spacing_w=0, spacing_h=0,
+                grid_start: str = 'origin') -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get the SW corner x and y coordinates of the grid cells that intersect
+    with `poly`, along with the cells themselves.
+    """
     xmin, ymin, xmax, ymax = poly.bounds
+    if poly.is_empty:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=object)
     if grid_start == 'origin':
         xmin = round_down_to(xmin, cell_w + spacing_w)
         ymin = round_down_to(ymin, cell_h + spacing_h)
@@ -93,12 +124,19 @@ def get_grid_cells(poly, cell_w, cell_h, spacing_w=0, spacing_h=0, grid_start: s
     elif grid_start != 'bounds':
         raise ValueError(f"Unrecognised grid_start: {grid_start}")
 
-    cells = []
-    for x in frange(xmin, xmax, cell_w + spacing_w):
-        for y in frange(ymin, ymax, cell_h + spacing_h):
-            cells.append(rect(x, y, cell_w, cell_h))
-    rtree = STRtree(cells)
-    return [cast(Polygon, cells[idx]) for idx in rtree.query(poly, predicate='intersects')]
+    # np.arange computes start + i * step, so unlike repeatedly adding the
+    # step the cell origins don't drift on long float grids:
+    xs = np.arange(xmin, xmax, cell_w + spacing_w, dtype=np.float64)
+    ys = np.arange(ymin, ymax, cell_h + spacing_h, dtype=np.float64)
+    # Cells are ordered row by row, starting from the SW corner:
+    yy, xx = np.meshgrid(ys, xs, indexing='ij')
+    xx = xx.ravel()
+    yy = yy.ravel()
+    cells = rects(xx, yy, cell_w, cell_h)
+    # Build poly's GEOS index once, rather than per intersects test:
+    shapely.prepare(poly)
+    intersecting = shapely.intersects(poly, cells)
+    return xx[intersecting], yy[intersecting], cells[intersecting]
 
 
 def get_grid_refs(poly, cell_size: int) -> List[str]:
@@ -107,14 +145,11 @@ def get_grid_refs(poly, cell_size: int) -> List[str]:
     e.g. SV54ne, or SM66) of the bottom left (SW) corner of each grid ref tile
     that intersects the polygon (which should be in srid 27700)
     """
-    grid_refs = []
-    for cell in get_grid_cells(poly, cell_size, cell_size):
-        x, y, _, _ = cell.bounds
-        if is_in_range(x, y):
-            grid_refs.append(en_to_grid_ref(x, y, cell_size))
-        else:
-            print(f"Cannot get grid ref for EN ({x},{y}) - out of bounds")
-    return grid_refs
+    xs, ys, _ = _grid_cells(poly, cell_size, cell_size)
+    valid = in_range(xs, ys)
+    for x, y in zip(xs[~valid], ys[~valid]):
+        print(f"Cannot get grid ref for EN ({x},{y}) - out of bounds")
+    return en_to_grid_refs(xs[valid], ys[valid], cell_size)
 
 
 def largest_polygon(g: Union[MultiPolygon, Polygon]):
@@ -128,7 +163,7 @@ def largest_polygon(g: Union[MultiPolygon, Polygon]):
     elif len(polygons) == 1:
         return polygons[0]
 
-    return max(polygons, key=lambda poly: poly.area)
+    return polygons[int(np.argmax(shapely.area(polygons)))]
 
 
 def multi(g: BaseGeometry) -> BaseMultipartGeometry:
@@ -157,12 +192,20 @@ def geoms(g: BaseGeometry) -> List[BaseGeometry]:
 
 def azimuth_rad(p1: Tuple[float, float], p2: Tuple[float, float]) -> float:
     angle = math.atan2(p2[0] - p1[0], p2[1] - p1[1])
-    return angle if angle > 0 else angle + math.pi
+    return angle + math.pi * (angle <= 0)
 
 
 def azimuth_deg(p1: Tuple[float, float], p2: Tuple[float, float]) -> float:
     angle = math.atan2(p2[0] - p1[0], p2[1] - p1[1])
-    return math.degrees(angle) if angle > 0 else math.degrees(angle) + 180
+    return math.degrees(angle) + 180 * (angle <= 0)
+
+
+def azimuths_deg(p1s: np.ndarray, p2s: np.ndarray) -> np.ndarray:
+    """
+    Vectorised azimuth_deg, for (n, 2) arrays of start and end points.
+    """
+    angles = np.arctan2(p2s[:, 0] - p1s[:, 0], p2s[:, 1] - p1s[:, 1])
+    return np.degrees(angles) + 180 * (angles <= 0)
 
 
 def project(x: float, y: float, src_srs: int, dst_srs: int) -> Tuple[float, float]:
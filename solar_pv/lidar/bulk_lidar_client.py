@@ -4,17 +4,34 @@ import enum
 import logging
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join
-from typing import List
+from typing import List, Set, Dict, Callable, Optional, Tuple
+
+import numpy as np
+from shapely.geometry import Polygon
 
 from osgeo import gdal
 
 from solar_pv import gdal_helpers
-from solar_pv.geos import bounds_polygon, get_grid_refs
+from solar_pv.geos import bounds_polygon, get_grid_refs, _grid_cells
 from solar_pv.lidar.defra_lidar_api_client import get_all_lidar
+from solar_pv.lidar.grid_ref import os_grid_ref_to_en
 from solar_pv.lidar.lidar import Resolution, zip_to_geotiffs, ZippedTiles, \
-    LidarTile, _file_res
+    LidarTile, _file_res, _tile_id
 from solar_pv.postgis import load_lidar
+from solar_pv.util import get_cpu_count, is_newer
+
+
+_TILE_SIZES = (500, 1000, 5000, 10000)
+"""
+Sizes in metres of the grid squares that tiles in bulk LiDAR zips can be named by
+"""
+
+
+def _lidar_workers():
+    """Zip extraction and GeoTIFF conversion is IO- and GDAL-bound, so threads scale"""
+    return min(8, get_cpu_count())
 
 
 class LidarSource(enum.Enum):
@@ -62,16 +79,41 @@ class LidarSource(enum.Enum):
             raise ValueError(f"Unsupported Lidar source {self}")
 
 
-def load_from_bulk(pg_conn, job_id: int, lidar_dir: str, bulk_lidar_dir: str) -> None:
+def load_from_bulk(pg_conn, job_id: int, lidar_dir: str, bulk_lidar_dir: str,
+                   workers: Optional[int] = None,
+                   only_best_res: bool = False) -> None:
     """
     Load LiDAR from the bulk LiDAR we have from DEFRA on bolt at `/srv/lidar`.
+
+    If `only_best_res` is True, only the finest resolution available for each
+    grid ref of each source is used. This is off by default as the resolution
+    used for a job is picked based on the coverage of each resolution.
     """
+    if workers is None:
+        workers = _lidar_workers()
     job_tmp_dir = join(lidar_dir, f"tmp_{job_id}")
 
-    job_tiles = []
+    bounds_poly = bounds_polygon(pg_conn, job_id)
+    # Sources share only a couple of distinct cell sizes:
+    grid_refs_by_cell_size: Dict[int, List[str]] = {}
+    # ...and the Scottish sources share a directory:
+    listings: Dict[str, Set[str]] = {}
+
+    to_prepare = []
     for source in LidarSource:
-        for tiles in lidar_tiles(pg_conn, job_id, bulk_lidar_dir, lidar_dir, source):
-            job_tiles.extend(tiles)
+        if source.cell_size not in grid_refs_by_cell_size:
+            grid_refs_by_cell_size[source.cell_size] = get_grid_refs(bounds_poly, source.cell_size)
+        grid_refs = grid_refs_by_cell_size[source.cell_size]
+        for filepath in lidar_files(grid_refs, bulk_lidar_dir, source, listings, only_best_res):
+            to_prepare.append((filepath, source))
+
+    # Preparing the tiles for all sources at once is DB-free, so doesn't need pg_conn:
+    job_tiles = []
+    in_bounds = _tile_in_bounds(bounds_poly)
+    if len(to_prepare) > 0:
+        with ThreadPoolExecutor(max_workers=min(workers, len(to_prepare))) as executor:
+            for tiles in executor.map(lambda fs: _bulk_tiles(fs[0], lidar_dir, fs[1], in_bounds), to_prepare):
+                job_tiles.extend(tiles)
 
     allow_api_lidar = os.environ.get("USE_LIDAR_FROM_API", False)
     if len(job_tiles) == 0 and allow_api_lidar:
@@ -95,31 +137,93 @@ def load_from_bulk(pg_conn, job_id: int, lidar_dir: str, bulk_lidar_dir: str) ->
         pass
 
 
-def lidar_tiles(pg_conn, job_id: int, bulk_lidar_dir: str, lidar_dir: str, source: LidarSource):
-    bounds_poly = bounds_polygon(pg_conn, job_id)
-    grid_refs = get_grid_refs(bounds_poly, source.cell_size)
+def lidar_files(grid_refs: List[str], bulk_lidar_dir: str, source: LidarSource,
+                listings: Dict[str, Set[str]], only_best_res: bool = False) -> List[str]:
+    """
+    Get the paths of the bulk LiDAR files from `source` that cover `grid_refs`.
 
+    `listings` caches the contents of the bulk LiDAR dirs, so that each is listed
+    once rather than stat-ing every candidate file.
+
+    If `only_best_res` is True, only get the finest resolution file for each grid ref.
+    """
+    filepaths = []
+    resolutions = sorted(source.resolutions, key=lambda r: r.value)
     for grid_ref in grid_refs:
-        for res in source.resolutions:
+        for res in resolutions:
             filepath = source.filepath(bulk_lidar_dir, grid_ref, res)
-            if os.path.exists(filepath):
+            dirname, basename = os.path.split(filepath)
+            if dirname not in listings:
+                listings[dirname] = _list_files(dirname)
+            if basename in listings[dirname]:
                 logging.info(f"Using LiDAR {'zip' if source.zipped else 'tile'} {filepath} "
                              f"from bulk LiDAR source {source}")
-                if source.zipped:
-                    zt = ZippedTiles.from_filename(filepath, source.year)
-                    yield zip_to_geotiffs(zt, lidar_dir)
-                else:
-                    dst_filepath = join(lidar_dir, os.path.basename(filepath))
-                    _fix_lidar_res(filepath)
-                    shutil.copyfile(filepath, dst_filepath)
-                    yield [LidarTile.from_filename(dst_filepath, source.year)]
+                filepaths.append(filepath)
+                if only_best_res:
+                    break
+    return filepaths
+
+
+def _list_files(dirname: str) -> Set[str]:
+    try:
+        with os.scandir(dirname) as it:
+            # is_file() uses the file type from the listing, so needs no stat:
+            return {entry.name for entry in it if entry.is_file()}
+    except FileNotFoundError:
+        return set()
+
+
+def _tile_in_bounds(bounds_poly: Polygon) -> Callable[[str], bool]:
+    """
+    Filter for the files in a bulk LiDAR zip, so that only the tiles that
+    intersect the job bounds are extracted. Files whose names don't contain a
+    parseable grid ref are kept.
+
+    The tiles that intersect the bounds are found up front, so the filter is
+    only a set lookup and is safe to call from several threads at once.
+    """
+    tiles_in_bounds: Set[Tuple[int, int, int]] = set()
+    for sq_size in _TILE_SIZES:
+        xs, ys, _ = _grid_cells(bounds_poly, sq_size, sq_size)
+        tiles_in_bounds.update((int(x), int(y), sq_size) for x, y in zip(np.rint(xs), np.rint(ys)))
+
+    def in_bounds(filename: str) -> bool:
+        tile_id = _tile_id(os.path.basename(filename))
+        if tile_id is None:
+            return True
+        try:
+            easting, northing, sq_size = os_grid_ref_to_en(tile_id)
+        except ValueError:
+            return True
+        return (easting, northing, sq_size) in tiles_in_bounds
+
+    return in_bounds
+
+
+def _bulk_tiles(filepath: str, lidar_dir: str, source: LidarSource,
+                member_filter: Callable[[str], bool] = None) -> List[LidarTile]:
+    if source.zipped:
+        zt = ZippedTiles.from_filename(filepath, source.year)
+        return zip_to_geotiffs(zt, lidar_dir, member_filter)
+    else:
+        dst_filepath = join(lidar_dir, os.path.basename(filepath))
+        _fix_lidar_res(filepath)
+        shutil.copyfile(filepath, dst_filepath)
+        return [LidarTile.from_filename(dst_filepath, source.year)]
 
 
 def _fix_lidar_res(filepath: str):
     """
     Scottish phase 1 LiDAR resolution is something like 1.000002, not 1. postGIS
     doesn't like that.
+
+    Writes a `.res_fixed` marker file next to the tile once its resolution is
+    known to be right, so later jobs can skip opening it.
     """
+    marker = filepath + '.res_fixed'
+    if is_newer(marker, filepath):
+        return
+
     curr_res = gdal_helpers.get_res_unchecked(filepath)
     filename = os.path.basename(filepath)
     filename_res = _file_res(filename).value
@@ -129,16 +233,36 @@ def _fix_lidar_res(filepath: str):
         gdal.UseExceptions()
         in_f = gdal.Open(filepath)
 
-        ulx, xres, xskew, uly, yskew, yres = in_f.GetGeoTransform()
+        orig_ulx, orig_xres, xskew, orig_uly, yskew, orig_yres = in_f.GetGeoTransform()
 
-        xres = -filename_res if xres < 0 else filename_res
-        yres = -filename_res if yres < 0 else filename_res
-        ulx = int(ulx)
-        uly = int(uly)
+        xres = -filename_res if orig_xres < 0 else filename_res
+        yres = -filename_res if orig_yres < 0 else filename_res
+        ulx = int(orig_ulx)
+        uly = int(orig_uly)
         lrx = ulx + int(in_f.RasterXSize * xres)
         lry = uly + int(in_f.RasterYSize * yres)
 
-        gdal.Warp(filepath, filepath,
-                  outputBounds=(ulx, lry, lrx, uly),
-                  xRes=filename_res, yRes=filename_res,
-                  creationOptions=['TILED=YES', 'COMPRESS=PACKBITS'])
+        # If the corrected grid is within half a pixel of the current one everywhere,
+        # only the geotransform needs fixing, not the pixels:
+        tolerance = filename_res / 2
+        if xskew == 0 and yskew == 0 \
+                and abs(orig_ulx - ulx) < tolerance \
+                and abs(orig_uly - uly) < tolerance \
+                and abs(orig_ulx + in_f.RasterXSize * orig_xres - lrx) < tolerance \
+                and abs(orig_uly + in_f.RasterYSize * orig_yres - lry) < tolerance:
+            in_f = None
+            ds = gdal.Open(filepath, gdal.GA_Update)
+            ds.SetGeoTransform((ulx, xres, 0, uly, 0, yres))
+            ds.FlushCache()
+            ds = None
+        else:
+            in_f = None
+            gdal.Warp(filepath, filepath,
+                      outputBounds=(ulx, lry, lrx, uly),
+                      xRes=filename_res, yRes=filename_res,
+                      creationOptions=['TILED=YES', 'COMPRESS=PACKBITS'])
+
+    try:
+        open(marker, 'w').close()
+    except OSError:
+        pass
@@ -3,25 +3,97 @@
 """
 DEFRA LiDAR API client
 """
+import dataclasses
 import json
 import logging
 import os
 import shutil
+import threading
 
 import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
 from datetime import datetime
 from os.path import join
 from typing import List
 
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from psycopg2.sql import SQL, Identifier
+from shapely import wkb
 
 from solar_pv.postgis import load_lidar
 from solar_pv.lidar.lidar import ZippedTiles, LidarTile, zip_to_geotiffs
 from solar_pv.paths import SQL_DIR
+from solar_pv.util import get_cpu_count
 
 _DEFRA_API = "https://environment.data.gov.uk/arcgis/rest"
 
+_DOWNLOAD_BUFSIZE = 1 << 20
+"""
+Size of the chunks that LiDAR zips are streamed to disk in
+"""
+
+_DOWNLOAD_TIMEOUT = (10, 300)
+"""
+Connect and read timeouts in seconds for LiDAR zip downloads
+"""
+
+_DOWNLOAD_THREADS = int(os.environ.get("LIDAR_DL_THREADS", 6))
+"""
+Number of LiDAR zips to download at once
+"""
+
+_MAX_ZIPS_ON_DISK = 8
+"""
+Maximum number of LiDAR zips that can be downloaded but not yet extracted
+and deleted, to cap the disk space used by a job
+"""
+
+_SR_27700 = {"wkid": 27700, "latestWkid": 27700}
+"""
+ArcGIS spatial reference for EPSG:27700
+"""
+
+_MAX_POLL_INTERVAL = 10
+"""
+Maximum number of seconds to wait between polls of a LiDAR job's status
+"""
+
+_MAX_CONCURRENT_JOBS = 4
+"""
+Maximum number of LiDAR API jobs (one per 20km square of the job bounds)
+to run at once
+"""
+
+# Shared so that connections to the DEFRA API are kept alive and reused. At most
+# _DOWNLOAD_THREADS downloads and one request per concurrent job are in flight:
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=4,
+                                       pool_maxsize=_DOWNLOAD_THREADS + _MAX_CONCURRENT_JOBS))
+
+
+@dataclasses.dataclass(frozen=True)
+class _DownloadPools:
+    """
+    Thread pools for downloading and extracting LiDAR zips, shared by all the
+    API jobs of a model job so that `_DOWNLOAD_THREADS` and `_MAX_ZIPS_ON_DISK`
+    are limits across all of them.
+    """
+    download: ThreadPoolExecutor
+    extract: ThreadPoolExecutor
+    zips_on_disk: threading.BoundedSemaphore
+
+
+@contextmanager
+def _download_pools():
+    with ThreadPoolExecutor(max_workers=get_cpu_count()) as extract_pool, \
+            ThreadPoolExecutor(max_workers=_DOWNLOAD_THREADS) as download_pool:
+        yield _DownloadPools(download=download_pool,
+                             extract=extract_pool,
+                             zips_on_disk=threading.BoundedSemaphore(_MAX_ZIPS_ON_DISK))
+
 
 def get_all_lidar(pg_conn, job_id: int, lidar_dir: str) -> None:
     """
@@ -34,8 +106,12 @@ def get_all_lidar(pg_conn, job_id: int, lidar_dir: str) -> None:
     gridded_bounds = _get_gridded_bounds(pg_conn, job_id)
     job_tiles = []
     logging.info(f"{len(gridded_bounds)} LiDAR jobs to run")
-    for rings in gridded_bounds:
-        job_tiles.extend(_get_lidar(rings=rings, lidar_dir=lidar_dir))
+    if len(gridded_bounds) > 0:
+        # Run the API jobs concurrently so that their waits for the API overlap:
+        with _download_pools() as pools, \
+                ThreadPoolExecutor(max_workers=min(_MAX_CONCURRENT_JOBS, len(gridded_bounds))) as executor:
+            for tiles in executor.map(lambda rings: _get_lidar(rings, lidar_dir, pools), gridded_bounds):
+                job_tiles.extend(tiles)
 
     load_lidar(pg_conn, job_tiles, job_tmp_dir)
 
@@ -47,7 +123,7 @@ def get_all_lidar(pg_conn, job_id: int, lidar_dir: str) -> None:
         pass
 
 
-def _get_gridded_bounds(pg_conn, job_id: int) -> List[List[List[float]]]:
+def _get_gridded_bounds(pg_conn, job_id: int) -> List[np.ndarray]:
     """
     Cut the job polygon into 20km by 20km squares - otherwise the defra API rejects
     the request as covering too large an area.
@@ -60,25 +136,24 @@ def _get_gridded_bounds(pg_conn, job_id: int) -> List[List[List[float]]]:
                 grid_table=Identifier(f'lidar_grid_{job_id}')), {'job_id': job_id})
             rows = cursor.fetchall()
             pg_conn.commit()
-            return [_wkt_to_rings(row[0]) for row in rows]
+            return [_wkb_to_rings(bytes(row[0])) for row in rows]
 
 
-def _wkt_to_rings(wkt: str) -> List[List[float]]:
-    if wkt.startswith("POLYGON"):
-        pairs = wkt.replace("POLYGON", "").replace("(", "").replace(")", "").split(",")
-        rings = []
-        for pair in pairs:
-            split = pair.split()
-            rings.append([float(split[0].strip()), float(split[1].strip())])
-        return rings
+def _wkb_to_rings(geom_wkb: bytes) -> np.ndarray:
+    """
+    Get the exterior ring of a polygon as an (n, 2) array of coordinates.
+    """
+    geom = wkb.loads(geom_wkb)
+    if geom.geom_type == "Polygon":
+        return np.asarray(geom.exterior.coords, dtype=np.float64)
     else:
         logging.warning(f"LiDAR area was not a polygon. Occasional points and "
                         f"linestrings might be possible results of intersecting "
-                        f"the grid with the bounding polygon: {wkt}")
-        return []
+                        f"the grid with the bounding polygon: {geom.wkt}")
+        return np.empty((0, 2))
 
 
-def _get_lidar(rings: List[List[float]], lidar_dir: str) -> List[LidarTile]:
+def _get_lidar(rings: np.ndarray, lidar_dir: str, pools: _DownloadPools) -> List[LidarTile]:
     """
     Get Lidar data from the defra internal API.
 
@@ -94,14 +169,14 @@ def _get_lidar(rings: List[List[float]], lidar_dir: str) -> List[LidarTile]:
         raise ValueError(f"Lidar job {lidar_job_id} failed: status {status}")
     logging.info(f"LiDAR job {lidar_job_id} completed with status {status}, downloading...")
 
-    job_tiles = _download_tiles(lidar_job_id, lidar_dir)
+    job_tiles = _download_tiles(lidar_job_id, lidar_dir, pools)
     logging.info(f"LiDAR data for {lidar_job_id} downloaded")
     return job_tiles
 
 
-def _start_job(rings: List[List[float]]) -> str:
+def _start_job(rings: np.ndarray) -> str:
     url = f'{_DEFRA_API}/services/gp/DataDownload/GPServer/DataDownload/submitJob'
-    res = requests.get(url, params={
+    res = _session.get(url, params={
         "f": "json",
         "OutputFormat": 0,
         "RequestMode": "Survey",
@@ -109,18 +184,12 @@ def _start_job(rings: List[List[float]]) -> str:
             "geometryType": "esriGeometryPolygon",
             "features": [{
                 "geometry": {
-                    "rings": [rings],
-                    "spatialReference": {
-                        "wkid": 27700,
-                        "latestWkid": 27700
-                    }
+                    "rings": [rings.tolist()],
+                    "spatialReference": _SR_27700
                 }
             }],
-            "sr": {
-                "wkid": 27700,
-                "latestWkid": 27700
-            }
-        }),
+            "sr": _SR_27700
+        }, separators=(',', ':')),
     })
     res.raise_for_status()
     body = res.json()
@@ -131,17 +200,19 @@ def _start_job(rings: List[List[float]]) -> str:
 
 
 def _wait_for_job(lidar_job_id: str) -> str:
+    interval = 0.5
     while True:
         status = _check_job_status(lidar_job_id)
         if status not in ('esriJobSubmitted', 'esriJobExecuting'):
             break
-        time.sleep(5)
+        time.sleep(interval)
+        interval = min(interval * 1.5, _MAX_POLL_INTERVAL)
     return status
 
 
 def _check_job_status(lidar_job_id: str) -> str:
     url = f'{_DEFRA_API}/services/gp/DataDownload/GPServer/DataDownload/jobs/{lidar_job_id}'
-    res = requests.get(url, params={"f": "json"})
+    res = _session.get(url, params={"f": "json"})
     res.raise_for_status()
     body = res.json()
     if 'jobStatus' in body:
@@ -150,9 +221,9 @@ def _check_job_status(lidar_job_id: str) -> str:
         raise ValueError(f"Received unhandled response while checking LiDAR job status: {body}")
 
 
-def _download_tiles(lidar_job_id: str, lidar_dir: str) -> List[LidarTile]:
+def _download_tiles(lidar_job_id: str, lidar_dir: str, pools: _DownloadPools) -> List[LidarTile]:
     url = f'{_DEFRA_API}/directories/arcgisjobs/gp/datadownload_gpserver/{lidar_job_id}/scratch/results.json'
-    res = requests.get(url)
+    res = _session.get(url)
     res.raise_for_status()
     body = res.json()
 
@@ -163,7 +234,7 @@ def _download_tiles(lidar_job_id: str, lidar_dir: str) -> List[LidarTile]:
         return 9999 if year == 'Latest' else int(year)
     latest = [max(p['years'], key=lambda year: year_to_key(year)) for p in products]
 
-    job_tiles = []
+    zts = []
     for la in latest:
         for resolution in la['resolutions']:
             for tile in resolution['tiles']:
@@ -171,23 +242,56 @@ def _download_tiles(lidar_job_id: str, lidar_dir: str) -> List[LidarTile]:
                 url = tile['url']
                 zt = ZippedTiles.from_url(url, year)
                 if zt:
-                    job_tiles.extend(_download_zip(zt, lidar_dir))
+                    # Adjacent API jobs can return the same zip, and may be
+                    # downloading it at the same time:
+                    zts.append(dataclasses.replace(zt, filename=f"{lidar_job_id}-{zt.filename}"))
+
+    return _download_zips(zts, lidar_dir, pools)
+
+
+def _download_zips(zts: List[ZippedTiles], lidar_dir: str, pools: _DownloadPools) -> List[LidarTile]:
+    """
+    Download zips and convert their contents to geotiffs, extracting each zip
+    as soon as it has downloaded so that extraction of one overlaps with the
+    download of the next.
+    """
+    def download(zt: ZippedTiles) -> Future:
+        pools.zips_on_disk.acquire()
+        try:
+            zip_path = _download_zip(zt, lidar_dir)
+            extracted = pools.extract.submit(_extract_zip, zt, zip_path, lidar_dir)
+        except BaseException:
+            pools.zips_on_disk.release()
+            raise
+        extracted.add_done_callback(lambda _: pools.zips_on_disk.release())
+        return extracted
+
+    downloads = [pools.download.submit(download, zt) for zt in zts]
+    job_tiles = []
+    for downloaded in downloads:
+        job_tiles.extend(downloaded.result().result())
 
     return job_tiles
 
 
-def _download_zip(zt: ZippedTiles, lidar_dir: str) -> List[LidarTile]:
+def _download_zip(zt: ZippedTiles, lidar_dir: str) -> str:
     """
-    Check if the zip should be used instead of existing versions,
-    extract the .asc files, and convert them to geotiffs.
+    Download the zip, returning the path it was saved to.
     """
-    res = requests.get(zt.url)
-    res.raise_for_status()
     zip_path = join(lidar_dir, zt.filename)
-    with open(zip_path, 'wb') as wz:
-        wz.write(res.content)
+    with _session.get(zt.url, stream=True, timeout=_DOWNLOAD_TIMEOUT) as res:
+        res.raise_for_status()
+        res.raw.decode_content = True
+        with open(zip_path, 'wb') as wz:
+            shutil.copyfileobj(res.raw, wz, _DOWNLOAD_BUFSIZE)
     logging.info(f"Downloaded {zt.url}")
+    return zip_path
+
 
+def _extract_zip(zt: ZippedTiles, zip_path: str, lidar_dir: str) -> List[LidarTile]:
+    """
+    Extract the .asc files, convert them to geotiffs and remove the zip.
+    """
     tiff_paths = zip_to_geotiffs(zt, lidar_dir)
 
     try:
@@ -1,5 +1,9 @@
 # This file is part of the solar wizard PV suitability model, copyright © Centre for Sustainable Energy, 2020-2023
 # Licensed under the Reciprocal Public License v1.5. See LICENSE for licensing details.
+from typing import List
+
+import numpy as np
+
 from solar_pv.util import round_down_to
 
 Easting = int
@@ -10,25 +14,21 @@ _100KM = 100000
 _10KM = 10000
 _1KM = 1000
 
-_1ST_LETTER = {
-    (0, 0): 'S',
-    (_500KM, 0): 'T',
-    (0, _500KM): 'N',
-    (_500KM, _500KM): 'O',
-    (0, _500KM * 2): 'H',
-}
+_1ST_LETTER_ROWS = ("ST", "NO", "H")
+"""1st grid ref letters, indexed by [northing // 500km][easting // 500km]"""
+
+_QUADRANT = ("sw", "se", "nw", "ne")
+"""Quadrants of a 10km square, indexed by (northing // 5km) * 2 + easting // 5km"""
 
 
 def is_in_range(easting: Easting, northing: Northing) -> bool:
-    easting = round_down_to(easting, _500KM)
-    northing = round_down_to(northing, _500KM)
-    return _1ST_LETTER.get((easting, northing), None) is not None
+    e5 = int(easting // _500KM)
+    n5 = int(northing // _500KM)
+    return 0 <= n5 < len(_1ST_LETTER_ROWS) and 0 <= e5 < len(_1ST_LETTER_ROWS[n5])
 
 
 def _get_1st_letter(easting: Easting, northing: Northing) -> str:
-    easting = round_down_to(easting, _500KM)
-    northing = round_down_to(northing, _500KM)
-    return _1ST_LETTER[(easting, northing)]
+    return _1ST_LETTER_ROWS[int(northing // _500KM)][int(easting // _500KM)]
 
 
 def _get_2nd_letter(easting: Easting, northing: Northing) -> str:
@@ -47,14 +47,7 @@ def _get_2nd_letter(easting: Easting, northing: Northing) -> str:
 
 def _get_quadrant(easting: Easting, northing: Northing) -> str:
     # Which quadrant within a 10km square the easting/northing are in
-    easting = round_down_to(easting % _10KM, 5000)
-    northing = round_down_to(northing % _10KM, 5000)
-    return {
-        (0, 0): "sw",
-        (0, 5000): "nw",
-        (5000, 0): "se",
-        (5000, 5000): "ne",
-    }[(easting, northing)]
+    return _QUADRANT[int((northing % _10KM) // 5000) * 2 + int((easting % _10KM) // 5000)]
 
 
 def en_to_grid_ref(easting: Easting, northing: Northing, square_size: int) -> str:
@@ -82,3 +75,57 @@ def en_to_grid_ref(easting: Easting, northing: Northing, square_size: int) -> st
 
     else:
         raise ValueError(f"Unhandled square size: {square_size}")
+
+
+_1ST_LETTERS = np.array([['S', 'T'],
+                         ['N', 'O'],
+                         ['H', '']])
+"""1st grid ref letters, indexed by [northing // 500km, easting // 500km]"""
+
+_2ND_LETTERS = np.array(list("ABCDEFGHJKLMNOPQRSTUVWXYZ"))
+"""2nd grid ref letters (all except I), indexed by 100km square id"""
+
+_QUADRANTS = np.array([["sw", "nw"],
+                       ["se", "ne"]])
+"""Quadrants of a 10km square, indexed by [easting // 5km, northing // 5km]"""
+
+
+def in_range(eastings: np.ndarray, northings: np.ndarray) -> np.ndarray:
+    """Vectorised version of `is_in_range`"""
+    e5 = np.floor_divide(eastings, _500KM).astype(np.int64)
+    n5 = np.floor_divide(northings, _500KM).astype(np.int64)
+    valid = (e5 >= 0) & (e5 < _1ST_LETTERS.shape[1]) & (n5 >= 0) & (n5 < _1ST_LETTERS.shape[0])
+    valid[valid] = _1ST_LETTERS[n5[valid], e5[valid]] != ''
+    return valid
+
+
+def en_to_grid_refs(eastings: np.ndarray, northings: np.ndarray, square_size: int) -> List[str]:
+    """
+    Vectorised version of `en_to_grid_ref`, for arrays of eastings and northings.
+    """
+    eastings = np.floor(np.asarray(eastings, dtype=float)).astype(np.int64)
+    northings = np.floor(np.asarray(northings, dtype=float)).astype(np.int64)
+    if not np.all(in_range(eastings, northings)):
+        raise ValueError("eastings and northings out of grid ref range")
+    if square_size not in (_500KM, _100KM, _10KM, 5000):
+        raise ValueError(f"Unhandled square size: {square_size}")
+
+    refs = _1ST_LETTERS[northings // _500KM, eastings // _500KM]
+    if square_size == _500KM:
+        return refs.tolist()
+
+    # How many 100kms above the nearest multiple of 500km the easting/northing are:
+    square_ids = 20 - ((northings % _500KM) // _100KM) * 5 + (eastings % _500KM) // _100KM
+    refs = np.char.add(refs, _2ND_LETTERS[square_ids])
+    if square_size == _100KM:
+        return refs.tolist()
+
+    # How many 10kms above the nearest multiple of 100km the easting/northing are:
+    refs = np.char.add(refs, ((eastings % _100KM) // _10KM).astype(str))
+    refs = np.char.add(refs, ((northings % _100KM) // _10KM).astype(str))
+    if square_size == _10KM:
+        return refs.tolist()
+
+    # Which quadrant within a 10km square the easting/northing are in:
+    refs = np.char.add(refs, _QUADRANTS[(eastings % _10KM) // 5000, (northings % _10KM) // 5000])
+    return refs.tolist()
@@ -7,9 +7,10 @@ from os.path import join
 import logging
 import os
 import re
+import threading
 import zipfile
 from osgeo import gdal, osr
-from typing import Optional, List
+from typing import Optional, List, Callable
 
 LIDAR_NODATA = -9999
 """
@@ -163,21 +164,42 @@ def _tile_id(filename: str):
     return match.group() if match is not None else None
 
 
-def zip_to_geotiffs(zt: ZippedTiles, lidar_dir: str) -> List[LidarTile]:
+_TIFF_LOCKS = tuple(threading.Lock() for _ in range(64))
+"""
+Fixed pool of locks for tiff paths being extracted, shared by hash of the path
+so that it doesn't grow with the number of tiles a process has extracted
+"""
+
+
+def _tiff_lock(tiff_path: str) -> threading.Lock:
+    return _TIFF_LOCKS[hash(tiff_path) % len(_TIFF_LOCKS)]
+
+
+def zip_to_geotiffs(zt: ZippedTiles, lidar_dir: str,
+                    member_filter: Callable[[str], bool] = None) -> List[LidarTile]:
+    """
+    Extract the LiDAR rasters in a zip and convert them to geotiffs. If
+    `member_filter` is passed, only the files it returns True for are used.
+    """
     tiff_paths = []
     with zipfile.ZipFile(join(lidar_dir, zt.filename)) as z:
         for zipinfo in z.infolist():
+            if member_filter is not None and not member_filter(zipinfo.filename):
+                continue
             # Convert to geotiff and add SRS metadata:
             asc_filename = zipinfo.filename
             tiff_filename = _get_tiff_filename(asc_filename)
             tiff_path = join(lidar_dir, tiff_filename)
-            if not os.path.exists(tiff_path):
-                z.extract(zipinfo, lidar_dir)
-                tile = LidarTile.from_filename(tiff_path, zt.year)
-                _asc_to_geotiff(lidar_dir, asc_filename, tiff_filename)
-                tiff_paths.append(tile)
-            else:
-                tiff_paths.append(LidarTile.from_filename(join(lidar_dir, tiff_filename), zt.year))
+            # Zips can be extracted concurrently, and different zips may contain
+            # the same tile:
+            with _tiff_lock(tiff_path):
+                if not os.path.exists(tiff_path):
+                    z.extract(zipinfo, lidar_dir)
+                    tile = LidarTile.from_filename(tiff_path, zt.year)
+                    _asc_to_geotiff(lidar_dir, asc_filename, tiff_filename)
+                    tiff_paths.append(tile)
+                else:
+                    tiff_paths.append(LidarTile.from_filename(join(lidar_dir, tiff_filename), zt.year))
 
     return tiff_paths
 
@@ -1,5 +1,6 @@
 # This file is part of the solar wizard PV suitability model, copyright © Centre for Sustainable Energy, 2020-2023
 # Licensed under the Reciprocal Public License v1.5. See LICENSE for licensing details.
+import io
 import json
 import logging
 import os
@@ -10,19 +11,29 @@ import unittest
 from typing import List
 from unittest import mock
 
-from solar_pv.lidar.defra_lidar_api_client import _get_lidar, _wkt_to_rings
+import numpy as np
+from shapely import wkt
+
+from solar_pv.lidar.defra_lidar_api_client import _get_lidar, _wkb_to_rings, \
+    _DOWNLOAD_TIMEOUT, _download_pools
 from solar_pv.lidar.lidar import LidarTile
 from solar_pv.paths import PROJECT_ROOT
 
 _lidar_dir = join(PROJECT_ROOT, "tmp")
 
 
-def mocked_requests_get(*args, **kwargs):
+def mocked_session_get(*args, **kwargs):
     class MockResponse:
         def __init__(self, json_data, status_code: int, content=None):
             self.json_data = json_data
             self.status_code = status_code
-            self.content = content
+            self.raw = io.BytesIO(content) if content is not None else None
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
 
         def json(self):
             return self.json_data
@@ -55,9 +66,10 @@ def mocked_requests_get(*args, **kwargs):
 
 class LidarTestCase(unittest.TestCase):
 
-    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    @mock.patch('solar_pv.lidar.defra_lidar_api_client._session.get', side_effect=mocked_session_get)
     def test_create_tiffs(self, mock_get):
-        tiffs = _get_lidar([[]], _lidar_dir)
+        with _download_pools() as pools:
+            tiffs = _get_lidar(np.empty((0, 2)), _lidar_dir, pools)
         self._assert_tiffs([
             "tl3555_DSM_1M.tiff",
             "tl3555_DSM_2M.tiff",
@@ -65,12 +77,14 @@ class LidarTestCase(unittest.TestCase):
             "tl3556_DSM_2M.tiff",
         ], tiffs)
 
-    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    @mock.patch('solar_pv.lidar.defra_lidar_api_client._session.get', side_effect=mocked_session_get)
     def test_prefer_1m(self, mock_get):
-        _get_lidar([[]], _lidar_dir)
+        with _download_pools() as pools:
+            _get_lidar(np.empty((0, 2)), _lidar_dir, pools)
 
         self.assertIn(
-            mock.call('https://environment.data.gov.uk/UserDownloads/interactive/5fe820254ea24f048900ea8d94dfdaa345872/LIDARCOMP/LIDAR-DSM-1M-TL35ne.zip'),
+            mock.call('https://environment.data.gov.uk/UserDownloads/interactive/5fe820254ea24f048900ea8d94dfdaa345872/LIDARCOMP/LIDAR-DSM-1M-TL35ne.zip',
+                      stream=True, timeout=_DOWNLOAD_TIMEOUT),
             mock_get.call_args_list)
 
     # Makes real API calls:
@@ -79,17 +93,17 @@ class LidarTestCase(unittest.TestCase):
     #     tiffs = os.listdir(_lidar_dir)
     #     assert len(tiffs) == 100, f"Wanted 100 tiffs, found {len(tiffs)}:\n {tiffs}"
 
-    def test_wkt_to_rings(self):
+    def test_wkb_to_rings(self):
         self._parameterised_test([
-            ('POLYGON((417649.533067673 206504.504705884,417649.533067673 226504.504705884,426447.445894151 226504.504705884,417649.533067673 206504.504705884))',
+            (wkt.loads('POLYGON((417649.533067673 206504.504705884,417649.533067673 226504.504705884,426447.445894151 226504.504705884,417649.533067673 206504.504705884))').wkb,
              [
                  [417649.533067673, 206504.504705884],
                  [417649.533067673, 226504.504705884],
                  [426447.445894151, 226504.504705884],
                  [417649.533067673, 206504.504705884],
              ]),
-            ('POINT(0 1)', [])
-        ], _wkt_to_rings)
+            (wkt.loads('POINT(0 1)').wkb, [])
+        ], lambda geom_wkb: _wkb_to_rings(geom_wkb).tolist())
 
     def _create_file(self, name: str):
         open(join(_lidar_dir, name), 'w').close()
@@ -1,7 +1,9 @@
 # This file is part of the solar wizard PV suitability model, copyright © Centre for Sustainable Energy, 2020-2023
 # Licensed under the Reciprocal Public License v1.5. See LICENSE for licensing details.
+import numpy as np
+
 from solar_pv.lidar.en_to_grid_ref import en_to_grid_ref, round_down_to, \
-    is_in_range
+    is_in_range, en_to_grid_refs, in_range
 from solar_pv.test_utils.test_funcs import ParameterisedTestCase
 
 
@@ -75,3 +77,20 @@ class EnToGridRefTest(ParameterisedTestCase):
             (999_999, 999_999, True),
             (1_000_000, 1_000_000, False),
         ], is_in_range)
+
+    def test_en_to_grid_refs(self):
+        eastings = np.array([0, 500000, 0, 400000, 50000, 5000, 460726])
+        northings = np.array([1000000, 0, 400000, 100000, 40000, 5000, 212585])
+        self.parameterised_test([
+            (eastings, northings, 500000, ['H', 'T', 'S', 'S', 'S', 'S', 'S']),
+            (eastings, northings, 100000, ['HV', 'TV', 'SA', 'SU', 'SV', 'SV', 'SP']),
+            (eastings, northings, 10000, ['HV00', 'TV00', 'SA00', 'SU00', 'SV54', 'SV00', 'SP61']),
+            (eastings, northings, 5000, ['HV00sw', 'TV00sw', 'SA00sw', 'SU00sw', 'SV54sw', 'SV00ne', 'SP61sw']),
+        ], en_to_grid_refs)
+
+    def test_in_range(self):
+        self.parameterised_test([
+            (np.array([-1, 0, 0, 0, 999_999, 1_000_000, 500_000]),
+             np.array([-1, 0, 1_500_000, 1_499_999, 999_999, 1_000_000, 1_000_000]),
+             [False, True, False, True, True, False, False]),
+        ], lambda eastings, northings: in_range(eastings, northings).tolist())
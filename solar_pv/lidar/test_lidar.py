@@ -1,6 +1,10 @@
 # This file is part of the solar wizard PV suitability model, copyright © Centre for Sustainable Energy, 2020-2023
 # Licensed under the Reciprocal Public License v1.5. See LICENSE for licensing details.
+import os
+import tempfile
+
 from solar_pv.lidar import lidar
+from solar_pv.lidar.bulk_lidar_client import lidar_files, LidarSource
 from solar_pv.test_utils.test_funcs import ParameterisedTestCase
 
 
@@ -99,3 +103,25 @@ class LidarTestCase(ParameterisedTestCase):
                     resolution=lidar.Resolution.R_50CM,
                     filename="/path/to/lidar/sp2917_DSM_50CM.tiff")),
         ], lidar.LidarTile.from_filename)
+
+    def test_lidar_files(self):
+        with tempfile.TemporaryDirectory() as bulk_lidar_dir:
+            # SP29se has 50cm and 1m zips, SP29sw only has a 1m zip, SP29nw has none:
+            for grid_ref, res in (("SP29se", lidar.Resolution.R_50CM),
+                                  ("SP29se", lidar.Resolution.R_1M),
+                                  ("SP29sw", lidar.Resolution.R_1M)):
+                filepath = LidarSource.ENGLAND.filepath(bulk_lidar_dir, grid_ref, res)
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                open(filepath, 'w').close()
+
+            def filenames(grid_refs, only_best_res):
+                files = lidar_files(grid_refs, bulk_lidar_dir, LidarSource.ENGLAND, {}, only_best_res)
+                return [os.path.basename(f) for f in files]
+
+            self.parameterised_test([
+                (["SP29se", "SP29sw", "SP29nw"], False,
+                 ["LIDAR-DSM-50CM-SP29se.zip", "LIDAR-DSM-1M-SP29se.zip", "LIDAR-DSM-1M-SP29sw.zip"]),
+                (["SP29se", "SP29sw", "SP29nw"], True,
+                 ["LIDAR-DSM-50CM-SP29se.zip", "LIDAR-DSM-1M-SP29sw.zip"]),
+                (["SP29nw"], True, []),
+            ], filenames)
@@ -6,7 +6,7 @@ import os
 from collections import defaultdict
 from os.path import join
 
-from psycopg2.sql import Identifier, SQL, Literal
+from psycopg2.sql import Identifier, SQL, Literal, Placeholder
 from typing import List, Dict
 
 from solar_pv.db_funcs import sql_script, sql_command
@@ -28,14 +28,10 @@ def load_lidar(pg_conn, tiles: List[LidarTile], temp_dir: str):
     # up to fit exactly
     # This is relied on by functionality in the lidar coverage model and the lidar
     # tile preparation for the heat demand model
-    r = _tiles_to_insert(pg_conn, tiles_by_res[Resolution.R_50CM], Resolution.R_50CM)
-    errors += rasters_to_postgis(pg_conn, r, "models.lidar_50cm", temp_dir, tile_size=1000, allow_errs=True)
-
-    r = _tiles_to_insert(pg_conn, tiles_by_res[Resolution.R_1M], Resolution.R_1M)
-    errors += rasters_to_postgis(pg_conn, r, "models.lidar_1m", temp_dir, tile_size=500, allow_errs=True)
-
-    r = _tiles_to_insert(pg_conn, tiles_by_res[Resolution.R_2M], Resolution.R_2M)
-    errors += rasters_to_postgis(pg_conn, r, "models.lidar_2m", temp_dir, tile_size=250, allow_errs=True)
+    to_insert = _tiles_to_insert(pg_conn, tiles_by_res)
+    errors += rasters_to_postgis(pg_conn, to_insert[Resolution.R_50CM], "models.lidar_50cm", temp_dir, tile_size=1000, allow_errs=True)
+    errors += rasters_to_postgis(pg_conn, to_insert[Resolution.R_1M], "models.lidar_1m", temp_dir, tile_size=500, allow_errs=True)
+    errors += rasters_to_postgis(pg_conn, to_insert[Resolution.R_2M], "models.lidar_2m", temp_dir, tile_size=250, allow_errs=True)
 
     error_pct = round(errors / len(tiles) * 100, 2)
     logging.info(f"LiDAR loaded, {errors} / {len(tiles)} ({error_pct}%) errored")
@@ -50,12 +46,15 @@ def rasters_to_postgis(pg_conn, rasters: List[str], table: str, temp_dir: str, t
 
     sql_file = join(temp_dir, "raster.sql")
     errors = 0
-    nodata = f'-N "{nodata_val}"' if nodata_val is not None else ''
-    srid = f'-s "{int(srid)}"' if srid is not None else ''
+    options = ["-n", "filename"]
+    if nodata_val is not None:
+        options.extend(["-N", str(nodata_val)])
+    if srid is not None:
+        options.extend(["-s", str(int(srid))])
+    options.extend(["-x", "-a", "-R", "-t", f"{tile_size}x{tile_size}"])
     for raster in rasters:
         try:
-            cmd = f'raster2pgsql -n filename {nodata} {srid} -x -a -R -t "{tile_size}x{tile_size}" "{raster}" "{table}" > {sql_file}'
-            run(cmd)
+            run(["raster2pgsql", *options, raster, table], out_file=sql_file)
             sql_script(pg_conn, sql_file)
         except Exception as e:
             pg_conn.rollback()
@@ -94,37 +93,49 @@ def create_raster_table(pg_conn, raster_table: str, drop: bool = False) -> None:
     )
 
 
-def _tiles_to_insert(pg_conn, paths: List[str], res: Resolution) -> List[str]:
+def _tiles_to_insert(pg_conn, tiles_by_res: Dict[Resolution, List[str]]) -> Dict[Resolution, List[str]]:
     """
-    Returns the tiles in the `tiles` list that are
-    not already on the database.
+    Returns the tiles in `tiles_by_res` that are not already on the database,
+    checking all resolutions in one query.
     """
-    if len(paths) == 0:
-        return []
-
-    if res == Resolution.R_50CM:
-        table = ("models", "lidar_50cm")
-    elif res == Resolution.R_1M:
-        table = ("models", "lidar_1m")
-    elif res == Resolution.R_2M:
-        table = ("models", "lidar_2m")
-    else:
-        raise ValueError(f"Unknown resolution {res}")
-
-    return sql_command(
+    to_insert = {res: [] for res in tiles_by_res}
+    queries = []
+    bindings = {}
+    for res, paths in tiles_by_res.items():
+        if len(paths) == 0:
+            continue
+
+        if res == Resolution.R_50CM:
+            table = ("models", "lidar_50cm")
+        elif res == Resolution.R_1M:
+            table = ("models", "lidar_1m")
+        elif res == Resolution.R_2M:
+            table = ("models", "lidar_2m")
+        else:
+            raise ValueError(f"Unknown resolution {res}")
+
+        bindings[res.name] = paths
+        queries.append(SQL(
+            """
+            SELECT {res} AS res, ins.filepath 
+            FROM UNNEST({paths}::text[]) AS ins (filepath) 
+            LEFT JOIN {table} ON ins.filepath LIKE '%%' || {table}.filename 
+            WHERE {table}.filename is null
+            """).format(res=Literal(res.name),
+                        paths=Placeholder(res.name),
+                        table=Identifier(*table)))
+
+    if len(queries) == 0:
+        return to_insert
+
+    rows = sql_command(
         pg_conn,
-        """
-        WITH ins as (
-            SELECT UNNEST(%(paths)s) AS filepath
-        ) 
-        SELECT ins.filepath 
-        FROM ins 
-        LEFT JOIN {table} ON ins.filepath LIKE '%%' || {table}.filename 
-        WHERE {table}.filename is null;
-        """,
-        bindings={"paths": paths},
-        table=Identifier(*table),
-        result_extractor=lambda rows: [row[0] for row in rows])
+        SQL(" UNION ALL ").join(queries),
+        bindings=bindings,
+        result_extractor=lambda rows: rows)
+    for res_name, filepath in rows:
+        to_insert[Resolution[res_name]].append(filepath)
+    return to_insert
 
 
 def _split_by_res(tiles: List[LidarTile]) -> Dict[Resolution, List[str]]:
@@ -23,7 +23,7 @@ from shapely.geometry import MultiPolygon
 from shapely.strtree import STRtree
 
 from solar_pv.db_funcs import count, sql_command, connection
-from solar_pv.geos import square
+from solar_pv.geos import squares
 from solar_pv.postgis import pixels_for_buildings
 from solar_pv import tables
 from solar_pv.util import get_cpu_count
@@ -145,10 +145,9 @@ def _aggregate_pixel_data(roof_planes,
     # create squares for each pixel:
     if debug:
         print("creating pixel square geoms...")
-    pixel_squares = []
-    for p in pixels:
-        ps = square(p['x'] - (resolution / 2.0), p['y'] - (resolution / 2.0), resolution)
-        pixel_squares.append(ps)
+    pixel_squares = squares([p['x'] - (resolution / 2.0) for p in pixels],
+                            [p['y'] - (resolution / 2.0) for p in pixels],
+                            resolution)
 
     # For each roof plane: get the pixels that intersect and the extent to which they intersect
     # then use that as a factor to calculate roof plane-level data.
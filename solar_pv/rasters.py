@@ -1,6 +1,7 @@
 # This file is part of the solar wizard PV suitability model, copyright © Centre for Sustainable Energy, 2020-2023
 # Licensed under the Reciprocal Public License v1.5. See LICENSE for licensing details.
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join
 
 import logging
@@ -22,6 +23,7 @@ from solar_pv.raster_names import MASK_27700_BUF1_TIF, MASK_27700_BUF0_TIF, ELEV
 from solar_pv.transformations import _7_PARAM_SHIFT
 
 
+@gdal_helpers.gdal_config()
 def generate_rasters(pg_uri: str,
                      job_id: int,
                      job_lidar_dir: str,
@@ -73,23 +75,23 @@ def generate_rasters(pg_uri: str,
     logging.info("Creating raster masks...")
     # Mask with a 1m buffer around buildings, for PVGIS:
     mask_sql_buf1 = mask.buildings_mask_sql(pg_uri, job_id, buffer=1)
-    mask.create_mask(mask_sql_buf1, mask_raster_buf1, pg_uri, res=res, srid=srid)
-    gdal_helpers.expand(mask_raster_buf1, mask_raster_buf1, buffer=horizon_search_radius)
+    _create_expanded_mask(pg_uri, mask_sql_buf1, mask_raster_buf1, res, srid, horizon_search_radius)
 
     # Mask with a 0m buffer around buildings, for invalid LiDAR detection:
     mask_sql_buf0 = mask.buildings_mask_sql(pg_uri, job_id, buffer=0)
-    mask.create_mask(mask_sql_buf0, mask_raster_buf0, pg_uri, res=res, srid=srid)
-    gdal_helpers.expand(mask_raster_buf0, mask_raster_buf0, buffer=horizon_search_radius)
+    _create_expanded_mask(pg_uri, mask_sql_buf0, mask_raster_buf0, res, srid, horizon_search_radius)
 
     logging.info("Cropping lidar to mask dimensions...")
     gdal_helpers.crop_or_expand(elevation_vrt, mask_raster_buf0, elevation_raster,
                                 adjust_resolution=True)
 
-    logging.info("Creating aspect raster...")
-    gdal_helpers.aspect(elevation_raster, aspect_raster)
-
-    logging.info("Creating slope raster...")
-    gdal_helpers.slope(elevation_raster, slope_raster)
+    logging.info("Creating aspect and slope rasters...")
+    # GDAL releases the GIL, so these can run concurrently in threads:
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        aspect_done = executor.submit(gdal_helpers.aspect, elevation_raster, aspect_raster)
+        slope_done = executor.submit(gdal_helpers.slope, elevation_raster, slope_raster)
+        aspect_done.result()
+        slope_done.result()
 
     logging.info("Check rasters are in / convert to 27700...")
     elevation_raster, mask_raster_buf1, mask_raster_buf0, slope_raster, aspect_raster = _generate_27700_rasters(
@@ -101,6 +103,16 @@ def generate_rasters(pg_uri: str,
     return elevation_raster, mask_raster_buf1, slope_raster, aspect_raster, res
 
 
+def _create_expanded_mask(pg_uri: str, mask_sql: str, mask_out: str, res: float, srid: int, buffer: int):
+    """
+    Create a mask raster and expand it by `buffer`. The unexpanded mask is only
+    an intermediate, so it is kept in memory rather than written to disk.
+    """
+    with gdal_helpers.vsimem_path() as unexpanded:
+        mask.create_mask(mask_sql, unexpanded, pg_uri, res=res, srid=srid)
+        gdal_helpers.expand(unexpanded, mask_out, buffer=buffer)
+
+
 def _generate_27700_rasters(solar_dir: str,
                             srid: int,
                             elevation_raster: str,
@@ -124,11 +136,19 @@ def _generate_27700_rasters(solar_dir: str,
         shutil.move(aspect_raster, aspect_raster_27700)
     else:
         dst_srs = _get_dst_srs_for_reproject(srid)
-        gdal_helpers.reproject(elevation_raster, elevation_raster_27700, src_srs=f"EPSG:{srid}", dst_srs=dst_srs)
-        gdal_helpers.reproject(mask_raster_buf1, mask_raster_buf1_27700, src_srs=f"EPSG:{srid}", dst_srs=dst_srs)
-        gdal_helpers.reproject(mask_raster_buf0, mask_raster_buf0_27700, src_srs=f"EPSG:{srid}", dst_srs=dst_srs)
-        gdal_helpers.reproject(slope_raster, slope_raster_27700, src_srs=f"EPSG:{srid}", dst_srs=dst_srs)
-        gdal_helpers.reproject(aspect_raster, aspect_raster_27700, src_srs=f"EPSG:{srid}", dst_srs=dst_srs)
+        to_reproject = [
+            (elevation_raster, elevation_raster_27700),
+            (mask_raster_buf1, mask_raster_buf1_27700),
+            (mask_raster_buf0, mask_raster_buf0_27700),
+            (slope_raster, slope_raster_27700),
+            (aspect_raster, aspect_raster_27700),
+        ]
+        # Each reprojection reads and writes its own files, so they can run concurrently.
+        # Only 2 at a time, as each warp already uses all CPUs and up to 2GB of memory:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(
+                lambda r: gdal_helpers.reproject(r[0], r[1], src_srs=f"EPSG:{srid}", dst_srs=dst_srs),
+                to_reproject))
 
     return elevation_raster_27700, mask_raster_buf1_27700, mask_raster_buf0_27700, slope_raster_27700, aspect_raster_27700
 
@@ -6,6 +6,7 @@ from typing import Set, Tuple, List, Optional
 import numpy as np
 import warnings
 import math
+import shapely
 from shapely.geometry import Polygon, MultiPoint
 from shapely.strtree import STRtree
 from sklearn import metrics
@@ -24,7 +25,7 @@ from skimage.measure import perimeter_crofton
 from solar_pv.constants import AZIMUTH_ALIGNMENT_THRESHOLD, \
     FLAT_ROOF_AZIMUTH_ALIGNMENT_THRESHOLD, ROOFDET_GOOD_SCORE, \
     FLAT_ROOF_DEGREES_THRESHOLD
-from solar_pv.geos import simplify_by_angle, polygon_line_segments, azimuth_deg, slope_deg, \
+from solar_pv.geos import simplify_by_angle, polygon_line_segments, azimuths_deg, slope_deg, \
     aspect_deg, aspect_rad, circular_mean_rad, circular_sd_rad, rad_diff, deg_diff
 
 
@@ -672,7 +673,8 @@ def get_potential_aspects(X_inlier_subset, polygon: Polygon) -> List[int]:
     if len(nearby) == 0:
         return []
 
-    azimuths_base = [int(azimuth_deg(line_segments[idx].coords[0], line_segments[idx].coords[1])) for idx in nearby]
+    coords = shapely.get_coordinates(np.take(line_segments, nearby)).reshape(-1, 2, 2)
+    azimuths_base = azimuths_deg(coords[:, 0], coords[:, 1]).astype(int).tolist()
     azimuths = set(azimuths_base)
     for az in azimuths_base:
         azimuths.add((az + 90) % 360)
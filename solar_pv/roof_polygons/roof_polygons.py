@@ -15,7 +15,7 @@ from shapely import affinity, ops, set_precision
 from shapely.geometry import Polygon, CAP_STYLE, JOIN_STYLE, MultiPolygon
 from shapely.validation import make_valid
 
-from solar_pv.geos import square, largest_polygon, get_grid_cells, \
+from solar_pv.geos import squares, largest_polygon, get_grid_cells, \
     de_zigzag
 from solar_pv.datatypes import RoofPlane, RoofPolygon
 from solar_pv.roof_polygons.split_evenly import split_evenly
@@ -142,7 +142,8 @@ def _make_polygon(plane: RoofPlane,
     # all the pixels and then de-zigzagging)
     halfr = resolution_metres / 2
     r = resolution_metres
-    pixels = [square(xy[0] - halfr, xy[1] - halfr, r) for xy in plane['inliers_xy']]
+    xy = np.asarray(plane['inliers_xy'], dtype=float).reshape(-1, 2)
+    pixels = squares(xy[:, 0] - halfr, xy[:, 1] - halfr, r)
     geom = ops.unary_union(pixels)
     geom = de_zigzag(geom)
     raw_roof_poly = largest_polygon(geom)
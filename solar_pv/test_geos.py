@@ -1,9 +1,11 @@
 # This file is part of the solar wizard PV suitability model, copyright © Centre for Sustainable Energy, 2020-2023
 # Licensed under the Reciprocal Public License v1.5. See LICENSE for licensing details.
+import numpy as np
 from shapely import wkt
 
 from solar_pv.geos import get_grid_refs, square, get_grid_cells, project, \
-    project_geom, largest_polygon, simplify_by_angle, polygon_line_segments
+    project_geom, largest_polygon, simplify_by_angle, polygon_line_segments, \
+    azimuth_deg, azimuths_deg, rect, rects, squares
 from solar_pv.test_utils.test_funcs import ParameterisedTestCase
 
 poly = wkt.loads("POLYGON((174470.31680707666 223518.17910779177,174276.26370506393 223546.12655343796,174091.39293130912 223611.39877670485,173922.81048688895 223711.4868656676,173776.9962875155 223842.54366778026,173659.55509069975 223999.53166544053,173575.0010619535 224176.41660640974,173526.58426080266 224366.39944638542,173516.16571608445 224562.17768839627,173592.06208690198 226246.89736822058,173620.03246149354 226440.9059367073,173685.3109052496 226625.73123606283,173785.38931157443 226794.27197027428,173916.4225013163 226940.05252346004,174073.37596095834 227057.47176382315,174250.21927701798 227142.01824846969,174440.1578345827 227190.44356056265,174635.893877738 227200.8871189106,176277.43827612288 227127.19793668273,176471.45017163677 227099.2587598961,176656.2848956962 227034.01048036112,176824.84087396128 226933.96001613676,176970.64198125486 226802.95142743978,177088.08636214878 226646.01822318762,177172.66166104548 226469.18996747906,177221.1183923546 226279.2606164265,177231.59478967154 226083.5274861198,177156.25176625728 224398.7982627386,177128.33552520312 224204.74183772347,177063.09347332583 224019.86164064688,176963.03333324415 223851.26395095012,176832.00113783564 223705.4291938767,176675.03339945318 223587.96285098934,176498.163520429 223503.3800010834,176308.1898859064 223454.9317731434,176112.4145528648 223444.480382007,174470.31680707666 223518.17910779177))")
@@ -96,3 +98,57 @@ class GeosTest(ParameterisedTestCase):
               'LINESTRING (20 -7, 0 -7)',
               'LINESTRING (0 -7, -10 10)']),
         ], _polygon_line_segments)
+
+    def test_azimuths_deg(self):
+        def vectorised_and_scalar(p1, p2):
+            vectorised = azimuths_deg(np.array([p1], dtype=float), np.array([p2], dtype=float))[0]
+            return round(float(vectorised), 9), round(azimuth_deg(p1, p2), 9)
+
+        self.parameterised_test([
+            # angle == 0:
+            ((0, 0), (0, 1), (180.0, 180.0)),
+            ((0, 0), (1, 1), (45.0, 45.0)),
+            ((0, 0), (1, 0), (90.0, 90.0)),
+            ((0, 0), (1, -1), (135.0, 135.0)),
+            ((0, 0), (0, -1), (180.0, 180.0)),
+            # negative angles:
+            ((0, 0), (-1, -1), (45.0, 45.0)),
+            ((0, 0), (-1, 0), (90.0, 90.0)),
+            ((0, 0), (-1, 1), (135.0, 135.0)),
+            ((10, 20), (13, 16), (143.130102354, 143.130102354)),
+        ], vectorised_and_scalar)
+
+    def test_azimuths_deg_many(self):
+        p1s = np.array([(0, 0), (0, 0), (5, 5), (10, 20), (-3, 2)], dtype=float)
+        p2s = np.array([(0, 1), (-1, -1), (5, 4), (13, 16), (-7, 9)], dtype=float)
+        self.parameterised_test([
+            (p1s, p2s, [round(azimuth_deg(p1, p2), 9) for p1, p2 in zip(p1s, p2s)]),
+        ], lambda a, b: [round(float(az), 9) for az in azimuths_deg(a, b)])
+
+    def test_rects(self):
+        def rings(xs, ys, w, h):
+            return [list(r.exterior.coords) for r in rects(xs, ys, w, h)]
+
+        self.parameterised_test([
+            # Clockwise from the SW corner, as rect() always built them:
+            ([0], [0], 2, 1, [[(0, 0), (0, 1), (2, 1), (2, 0), (0, 0)]]),
+            ([10, -5.5], [20, 3], 4, 3, [[(10, 20), (10, 23), (14, 23), (14, 20), (10, 20)],
+                                         [(-5.5, 3), (-5.5, 6), (-1.5, 6), (-1.5, 3), (-5.5, 3)]]),
+            ([], [], 1, 1, []),
+        ], rings)
+
+    def test_rects_match_rect(self):
+        self.parameterised_test([
+            (7.5, 2, 3, 0.5, True),
+            (-100, 50, 10, 20, True),
+        ], lambda x, y, w, h: rects([x], [y], w, h)[0].equals_exact(rect(x, y, w, h), 0))
+
+    def test_squares(self):
+        def rings(xs, ys, edge):
+            return [list(s.exterior.coords) for s in squares(xs, ys, edge)]
+
+        self.parameterised_test([
+            ([0, 5], [0, 10], 5, [[(0, 0), (0, 5), (5, 5), (5, 0), (0, 0)],
+                                  [(5, 10), (5, 15), (10, 15), (10, 10), (5, 10)]]),
+            ([460965], [366311], 1000, [list(poly3.exterior.coords)]),
+        ], rings)
@@ -13,8 +13,11 @@ except ModuleNotFoundError:
 
 import psycopg2
 import psycopg2.extras
+from osgeo import gdal
 
+from solar_pv import gdal_helpers
 from solar_pv.rasters import create_elevation_override_raster
+from solar_pv.test_utils.test_funcs import ParameterisedTestCase
 
 _TEST_ELEVATION_RASTER: str = os.path.realpath(
     "../testdata/solar_pv/rasters/inputs/elevation_4326.tif")
@@ -163,5 +166,34 @@ class RastersTests(unittest.TestCase):
                         self.assertIs(len(res.stdout.strip()), 0)
 
 
+class TranslateWindowTest(ParameterisedTestCase):
+    def test_translate_window(self):
+        def translate_window(bounds, xres, yres, src_geotransform=(100, 1, 0, 200, 0, -1)):
+            src = gdal.GetDriverByName('MEM').Create('', 10, 10, 1, gdal.GDT_Float32)
+            src.SetGeoTransform(src_geotransform)
+            with gdal_helpers.vsimem_path() as out_tiff:
+                translated = gdal_helpers._translate_window(src, out_tiff, bounds, xres, yres)
+                if not translated:
+                    return False, gdal.VSIStatL(out_tiff) is not None
+                out = gdal.Open(out_tiff)
+                result = True, out.GetGeoTransform(), out.RasterXSize, out.RasterYSize
+                out = None
+                return result
+
+        self.parameterised_test([
+            # Aligned with the source pixel grid at the same resolution:
+            ((102, 190, 108, 198), 1, 1, (True, (102, 1, 0, 198, 0, -1), 6, 8)),
+            # Expanding beyond the source is fine, as long as it's aligned:
+            ((98, 188, 112, 202), 1, 1, (True, (98, 1, 0, 202, 0, -1), 14, 14)),
+            # Misaligned with the source pixel grid:
+            ((102.5, 190, 108.5, 198), 1, 1, (False, False)),
+            ((102, 190.25, 108, 198.25), 1, 1, (False, False)),
+            # Different resolution:
+            ((102, 190, 108, 198), 2, 2, (False, False)),
+            # Skewed source:
+            ((102, 190, 108, 198), 1, 1, (100, 1, 0.1, 200, 0, -1), (False, False)),
+        ], translate_window)
+
+
 if __name__ == '__main__':
     unittest.main()